@@ -1,42 +1,91 @@
+import asyncio
+import hashlib
 import json
+import math
+import os
+import tarfile
 import time
-from difflib import get_close_matches
+import zipfile
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from pathlib import Path
 from uuid import uuid4
 
 import modal
-import torch
 import uvicorn
-from fastapi import FastAPI, HTTPException, UploadFile
+from fastapi import FastAPI, Header, HTTPException, Request, Response, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from PIL import ImageFile
+
+from engine import ENGINE_BACKEND, GUIDED_DECODING_BACKEND, Completion, get_engine
 from utils import (
     APP_NAME,
+    ARTIFACTS_PATH,
+    DEFAULT_ALL_USER_PROMPT,
     DEFAULT_IMG_PATHS,
     DEFAULT_SYSTEM_PROMPT,
     DEFAULT_USER_PROMPT,
     GPU_IMAGE,
-    JSON_STRUCTURE,
+    IMAGE_EXTENSIONS,
+    MAX_FILE_SIZE_BYTES,
     MINUTES,
+    PRETRAINED_VOLUME,
     PROCESSOR,
+    RESIZE_DIMENSIONS,
+    SCANNER,
     SECRETS,
+    SFT_ALL_HF_MODEL,
+    SFT_INT_HF_MODEL,
     SFT_QUANT_MODEL,
     SUBSTRUCTURE_INFO,
+    UPLOAD_MAX_BYTES,
     VOLUME_CONFIG,
     Colors,
+    UploadLimitMiddleware,
+    build_conversations,
+    build_schemas,
+    load_image,
+    local_gpu_count,
+    parse_outputs,
+    scale_points,
+    validate_image_bytes,
     validate_image_file,
 )
-from vllm import LLM, SamplingParams
-from vllm.sampling_params import GuidedDecodingParams
 
 # -----------------------------------------------------------------------------
 
+# serving config
+
+SERVING_MODE = os.getenv("SERVING_MODE", "async")  # "sync" or "async"
+ASYNC_SERVING = SERVING_MODE == "async"
+ONE_SHOT = os.getenv("ONE_SHOT", "0") == "1"  # one prompt for all substructures
+INT_COORDS = os.getenv("INT_COORDS", "0") == "1"  # whole-pixel points, fewer tokens
+if ONE_SHOT and INT_COORDS:  # no one-shot model was trained on int points
+    raise ValueError("Pick one of `ONE_SHOT` or `INT_COORDS`")
+
 # vlm config
 
-MODEL = SFT_QUANT_MODEL
-QUANTIZATION = "awq_marlin"
+MODEL = (
+    SFT_ALL_HF_MODEL
+    if ONE_SHOT
+    else SFT_INT_HF_MODEL
+    if INT_COORDS
+    else SFT_QUANT_MODEL
+)
+QUANTIZATION = None if ONE_SHOT or INT_COORDS else "awq_marlin"
 KV_CACHE_DTYPE = None  # "fp8_e5m2"
 LIMIT_MM_PER_PROMPT = {"image": 1}
 ENFORCE_EAGER = False
-MAX_NUM_SEQS = 1
+ENABLE_PREFIX_CACHING = True  # prefill system prompt + image once per image
+MAX_NUM_SEQS = int(
+    os.getenv(
+        "MAX_NUM_SEQS",
+        # async: several uploads' substructure prompts in flight at once
+        str(8 * len(SUBSTRUCTURE_INFO) if ASYNC_SERVING else len(SUBSTRUCTURE_INFO)),
+    )
+)
 MIN_PIXELS = 28 * 28
 MAX_PIXELS = 1280 * 28 * 28
 TEMPERATURE = 0.0
@@ -46,19 +95,66 @@ STOP_TOKEN_IDS = []
 MAX_MODEL_LEN = 32768
 MAX_TOKENS = 4096
 
+JSON_SCHEMAS = build_schemas(  # one per prompt, built at startup
+    one_shot=ONE_SHOT, int_coords=INT_COORDS
+)
+SAMPLING_KWARGS = {
+    "temperature": TEMPERATURE,
+    "top_p": TOP_P,
+    "repetition_penalty": REPEATION_PENALTY,
+    "stop_token_ids": STOP_TOKEN_IDS,
+    "max_tokens": MAX_TOKENS,
+}
+
 MAX_FILE_SIZE_MB = 5
 MAX_DIMENSIONS = (4096, 4096)
 
+# result cache
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))  # entries in memory
+RESULT_CACHE_DISK = os.getenv("RESULT_CACHE_DISK", "1") == "1"
+
+# metrics
+
+STAGES = ["queue", "prefill", "decode"]  # engine stages reported per completion
+SUBSTRUCTURE_NAMES = ["all"] if ONE_SHOT else list(SUBSTRUCTURE_INFO)  # per prompt
+
+# admission control
+
+ADMISSION_MAX_ACTIVE = int(  # generations on the engine at once
+    os.getenv("ADMISSION_MAX_ACTIVE", str(MAX_NUM_SEQS // len(JSON_SCHEMAS)))
+)
+ADMISSION_MAX_QUEUE = int(
+    os.getenv("ADMISSION_MAX_QUEUE", str(4 * ADMISSION_MAX_ACTIVE))
+)  # generations waiting for a slot
+ADMISSION_SERVICE_SECONDS = float(
+    os.getenv("ADMISSION_SERVICE_SECONDS", "10")
+)  # initial guess, refined as generations finish
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "120"))
+DISCONNECT_POLL_SECONDS = 0.5  # how often a waiting request checks its client
+
+# startup
+
+WARMUP_IMG_PATH = DEFAULT_IMG_PATHS[0]  # synthetic request run before serving
+
+# batch labelling
+
+BATCH_MAX_INFLIGHT = int(os.getenv("BATCH_MAX_INFLIGHT", "64"))  # images per /batch
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(512 * 1024 * 1024)))  # body size
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz")
+
 # -----------------------------------------------------------------------------
 
 # Modal
 
 TIMEOUT = 24 * 60 * MINUTES
 SCALEDOWN_WINDOW = 5 * MINUTES
-ALLOW_CONCURRENT_INPUTS = 1
+ALLOW_CONCURRENT_INPUTS = int(
+    os.getenv("ALLOW_CONCURRENT_INPUTS", "16" if ASYNC_SERVING else "1")
+)
 
 if modal.is_local():
-    GPU_COUNT = torch.cuda.device_count()
+    GPU_COUNT = local_gpu_count()
 else:
     GPU_COUNT = 1
 
@@ -67,6 +163,425 @@ GPU_CONFIG = f"{GPU_TYPE}:{GPU_COUNT}"
 
 app = modal.App(name=f"{APP_NAME}-api")
 
+API_IMAGE = GPU_IMAGE.add_local_file(
+    WARMUP_IMG_PATH, f"/artifacts/data/{WARMUP_IMG_PATH.name}"
+)
+
+if modal.is_local():
+    RESULT_CACHE_PATH = ARTIFACTS_PATH / "cache" / "api"
+else:
+    RESULT_CACHE_PATH = Path(f"/{PRETRAINED_VOLUME}") / "cache" / "api"
+
+# -----------------------------------------------------------------------------
+
+# helpers
+
+
+class ResultCache:
+    """
+    Content-addressed cache of API responses.
+
+    Keys hash the image bytes together with everything else that determines the
+    output (backend, model, preprocessing, prompts, sampling params, schemas),
+    so a hit is always safe to serve with greedy decoding. Entries live in an in-memory LRU and, optionally, as
+    JSON files on disk that survive container restarts.
+    """
+
+    def __init__(self, namespace: str, max_size: int, disk_path: Path | None = None):
+        self.namespace = hashlib.sha256(namespace.encode()).digest()
+        self.max_size = max_size
+        self.disk_path = disk_path
+        if self.disk_path is not None:
+            self.disk_path.mkdir(parents=True, exist_ok=True)
+        self.entries = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, img_bytes: bytes) -> str:
+        return hashlib.sha256(self.namespace + img_bytes).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+            return self.entries[key]
+        if self.disk_path is not None:
+            path = self.disk_path / f"{key}.json"
+            try:
+                with open(path, "r") as f:
+                    value = json.load(f)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self._remember(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: dict):
+        self._remember(key, value)
+        if self.disk_path is not None:
+            path = self.disk_path / f"{key}.json"
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(value, f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Failed to write cache entry {key}: {e}")
+
+    def _remember(self, key: str, value: dict):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int | float]:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "size": len(self.entries),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+        }
+
+
+class Progress:
+    """Partial results of one in-flight generation, replayed to every follower."""
+
+    def __init__(self):
+        self.items: list = []
+        self.changed = asyncio.Event()
+        self.timings: dict[str, float] = {}  # stage -> seconds, for Server-Timing
+        self.waiters = 0  # callers still interested in the result
+
+    def add(self, item):
+        self.items.append(item)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self, task: asyncio.Task, deadline: float = None):
+        """Yield every item, past and future, until `task` is done.
+
+        Raises `TimeoutError` if `deadline` (monotonic) passes first."""
+        i = 0
+        while True:
+            changed = self.changed  # grab before reading so no item is missed
+            while i < len(self.items):
+                yield self.items[i]
+                i += 1
+            if task.done():
+                return
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                raise TimeoutError
+            waiter = asyncio.ensure_future(changed.wait())
+            await asyncio.wait(
+                [waiter, task], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            waiter.cancel()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key onto one in-flight task.
+
+    The first caller starts the work; callers that arrive before it finishes
+    await the same result (or exception) instead of starting their own.
+    `fn` receives the task's `Progress` so callers can stream partial results.
+    Every `join` must be paired with a `leave`; when the last caller leaves
+    before the task is done, nobody will read the result and it is cancelled.
+    """
+
+    def __init__(self):
+        self.inflight: dict[str, tuple[asyncio.Task, Progress]] = {}
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def join(self, key: str, fn) -> tuple[asyncio.Task, Progress]:
+        if key in self.inflight:
+            self.coalesced += 1
+            task, progress = self.inflight[key]
+        else:
+            progress = Progress()
+            task = asyncio.ensure_future(fn(progress))
+            self.inflight[key] = (task, progress)
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        progress.waiters += 1
+        return task, progress
+
+    def leave(self, task: asyncio.Task, progress: Progress):
+        progress.waiters -= 1
+        if progress.waiters == 0 and not task.done():
+            task.cancel()
+            self.cancelled += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "inflight": len(self.inflight),
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+
+
+class LeavingStreamingResponse(StreamingResponse):
+    """
+    `StreamingResponse` that calls `leave` once it is done with the body.
+
+    It runs however the response ends: streamed, failed, or cancelled. That
+    includes a client that is gone before the first chunk, when the body's
+    generator never starts and its own `finally` never runs.
+    """
+
+    def __init__(self, content, leave=None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.leave = leave
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.leave is not None:
+                self.leave()
+
+
+class Admission:
+    """
+    Bounded FIFO queue in front of the engine.
+
+    At most `max_active` generations run at once and at most `max_queue` wait
+    for a slot. A caller is rejected up front, with a `Retry-After` hint, when
+    the queue is full (429) or when its expected wait plus its own service
+    time, both estimated from a moving average of recent service times, would
+    overrun its deadline (503). A free slot is always taken, so the estimate
+    keeps learning even when callers' deadlines are tight.
+    """
+
+    def __init__(
+        self, max_active: int, max_queue: int, service_seconds: float, alpha=0.2
+    ):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.service_seconds = service_seconds
+        self.alpha = alpha
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+    def expected_wait(self) -> float:
+        """Seconds until a new arrival would get a slot."""
+        if self.active < self.max_active and not self.waiters:
+            return 0.0
+        return (len(self.waiters) + 1) * self.service_seconds / self.max_active
+
+    def reject(self, status_code: int, msg: str, retry_after: float):
+        raise HTTPException(
+            status_code=status_code,
+            detail=msg,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    async def acquire(self, deadline: float, fail_fast: bool = True) -> float:
+        """Wait for a slot until `deadline` (monotonic); return seconds waited."""
+        if self.active < self.max_active and not self.waiters:
+            self.active += 1
+            return 0.0
+        wait = self.expected_wait()
+        if fail_fast and len(self.waiters) >= self.max_queue:
+            self.reject(429, "Server busy: request queue is full", wait)
+        start = time.monotonic()
+        if fail_fast and start + wait + self.service_seconds > deadline:
+            self.reject(
+                503,
+                f"Expected wait of {wait:.1f}s plus {self.service_seconds:.1f}s "
+                "of generation exceeds deadline",
+                wait,
+            )
+        slot = asyncio.get_running_loop().create_future()
+        self.waiters.append(slot)
+        try:
+            await asyncio.wait_for(asyncio.shield(slot), max(0.0, deadline - start))
+        except (TimeoutError, asyncio.CancelledError) as e:
+            if slot.done():
+                self.release()  # handed a slot just as we gave up: pass it on
+            else:
+                slot.cancel()
+                self.waiters.remove(slot)
+            if isinstance(e, TimeoutError):
+                self.reject(503, "Deadline exceeded while queued", self.expected_wait())
+            raise
+        return time.monotonic() - start
+
+    def release(self, service_seconds: float = None):
+        """Free a slot, handing it straight to the oldest waiter if any."""
+        if service_seconds is not None:
+            self.service_seconds += self.alpha * (
+                service_seconds - self.service_seconds
+            )
+        while self.waiters:
+            slot = self.waiters.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "admission_active": self.active,
+            "admission_queue_depth": len(self.waiters),
+            "admission_expected_wait_seconds": round(self.expected_wait(), 3),
+            "admission_service_seconds": round(self.service_seconds, 3),
+        }
+
+
+class Metrics:
+    """
+    In-process counters and histograms rendered in Prometheus text format.
+
+    Each series is a metric name plus its label values; histograms share one
+    set of latency buckets (seconds).
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, prefix: str = APP_NAME):
+        self.prefix = prefix
+        self.counters: dict[str, dict[tuple, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        # per series: one count per bucket (+Inf last), then the sum
+        self.histograms: dict[str, dict[tuple, list]] = defaultdict(dict)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[name][tuple(sorted(labels.items()))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms[name].setdefault(
+            tuple(sorted(labels.items())), [0] * (len(self.BUCKETS) + 1) + [0.0]
+        )
+        series[bisect_left(self.BUCKETS, value)] += 1
+        series[-1] += value
+
+    @staticmethod
+    def labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def render(self, gauges: dict[str, float] = None) -> str:
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            for labels, value in series.items():
+                lines.append(f"{self.prefix}_{name}{self.labels(labels)} {value}")
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for labels, counts in series.items():
+                cumulative = 0
+                for le, count in zip([*self.BUCKETS, "+Inf"], counts[:-1]):
+                    cumulative += count
+                    bucket = self.labels((*labels, ("le", le)))
+                    lines.append(f"{self.prefix}_{name}_bucket{bucket} {cumulative}")
+                lines.append(
+                    f"{self.prefix}_{name}_sum{self.labels(labels)} {counts[-1]}"
+                )
+                lines.append(
+                    f"{self.prefix}_{name}_count{self.labels(labels)} {cumulative}"
+                )
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+async def cancel_on_disconnect(request: Request, coro):
+    """Await `coro`, cancelling it if the client goes away first."""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait([task], timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+class StartupReport:
+    """Duration of each container startup phase, in the order they ran."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases: dict[str, float] = {}
+        self.ready = False
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.monotonic() - start, 3)
+            print(f"startup: {name} took {self.phases[name]:.2f} seconds")
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phases": self.phases,
+            "total_seconds": round(sum(self.phases.values()), 3),
+        }
+
+
+def server_timing(timings: dict[str, float]) -> str:
+    return ", ".join(f"{k};dur={v * 1000:.1f}" for k, v in timings.items())
+
+
+def read_limited(f, size: int = None) -> tuple[bytes | None, str | None]:
+    """Read at most MAX_FILE_SIZE_BYTES, so an archive member can't decompress
+    without bound; `size` is the member's declared size, checked first."""
+    error = f"File size exceeds {MAX_FILE_SIZE_MB}MB limit."
+    if size is not None and size > MAX_FILE_SIZE_BYTES:
+        return None, error
+    img_bytes = f.read(MAX_FILE_SIZE_BYTES + 1)
+    if len(img_bytes) > MAX_FILE_SIZE_BYTES:
+        return None, error
+    return img_bytes, None
+
+
+def iter_batch_images(image_files: list[UploadFile]):
+    """Yield (filename, bytes, error) for every image in the uploads, expanding
+    archives; oversize members carry an error instead of bytes."""
+    for image_file in image_files:
+        name = image_file.filename.lower()
+        image_file.file.seek(0)
+        if name.endswith(".zip"):
+            with zipfile.ZipFile(image_file.file) as archive:
+                for info in archive.infolist():
+                    if (
+                        not info.is_dir()
+                        and Path(info.filename).suffix.lower() in IMAGE_EXTENSIONS
+                    ):
+                        with archive.open(info) as f:
+                            yield info.filename, *read_limited(f, info.file_size)
+        elif name.endswith(ARCHIVE_SUFFIXES):
+            with tarfile.open(fileobj=image_file.file, mode="r|*") as archive:
+                for member in archive:
+                    if (
+                        member.isfile()
+                        and Path(member.name).suffix.lower() in IMAGE_EXTENSIONS
+                    ):
+                        f = archive.extractfile(member)
+                        yield member.name, *read_limited(f, member.size)
+        else:
+            yield image_file.filename, *read_limited(image_file.file)
+
+
 # -----------------------------------------------------------------------------
 
 # main
@@ -74,94 +589,330 @@ app = modal.App(name=f"{APP_NAME}-api")
 
 def get_app():  # noqa: C901
     ## setup
-    f_app = FastAPI()
     ImageFile.LOAD_TRUNCATED_IMAGES = True
+    startup = StartupReport()
+
+    with startup.phase("engine"):  # download + load weights, capture graphs
+        engine = get_engine(
+            ENGINE_BACKEND,
+            asynchronous=ASYNC_SERVING,
+            llm_kwargs={
+                "model": MODEL,
+                "tokenizer": PROCESSOR,
+                "limit_mm_per_prompt": LIMIT_MM_PER_PROMPT,
+                "enforce_eager": ENFORCE_EAGER,
+                "enable_prefix_caching": ENABLE_PREFIX_CACHING,
+                "guided_decoding_backend": GUIDED_DECODING_BACKEND,
+                "max_num_seqs": MAX_NUM_SEQS,
+                "tensor_parallel_size": GPU_COUNT,
+                "trust_remote_code": True,
+                "max_model_len": MAX_MODEL_LEN,
+                "mm_processor_kwargs": {
+                    "min_pixels": MIN_PIXELS,
+                    "max_pixels": MAX_PIXELS,
+                },
+                **{
+                    k: v
+                    for k, v in [
+                        ("quantization", QUANTIZATION),
+                        ("kv_cache_dtype", KV_CACHE_DTYPE),
+                    ]
+                    if v is not None
+                },
+            },
+            sampling_kwargs=SAMPLING_KWARGS,
+            json_schemas=JSON_SCHEMAS,
+        )
+
+    @asynccontextmanager
+    async def lifespan(f_app: FastAPI):
+        # pay every lazy cost here rather than on the first user's request
+        with startup.phase("grammars"):
+            await engine.awarmup()
+        img_bytes = WARMUP_IMG_PATH.read_bytes()
+        with startup.phase("scanner"):  # spawn the antivirus workers
+            response = await asyncio.to_thread(validate_image_bytes, img_bytes)
+        if "error" in response:
+            raise RuntimeError(f"Warmup image rejected: {response['error']}")
+        with startup.phase("warmup_request"):
+            await generate(cache.key(img_bytes), img_bytes, "warmup", Progress())
+        startup.ready = True
+        print(f"startup: ready after {startup.report()['total_seconds']:.2f} seconds")
+        yield
+        startup.ready = False  # draining
 
-    llm = LLM(
-        model=MODEL,
-        tokenizer=PROCESSOR,
-        limit_mm_per_prompt=LIMIT_MM_PER_PROMPT,
-        enforce_eager=ENFORCE_EAGER,
-        max_num_seqs=MAX_NUM_SEQS,
-        tensor_parallel_size=GPU_COUNT,
-        trust_remote_code=True,
-        max_model_len=MAX_MODEL_LEN,
-        mm_processor_kwargs={
-            "min_pixels": MIN_PIXELS,
-            "max_pixels": MAX_PIXELS,
-        },
-        **{
-            k: v
-            for k, v in [
-                ("quantization", QUANTIZATION),
-                ("kv_cache_dtype", KV_CACHE_DTYPE),
-            ]
-            if v is not None
-        },
+    f_app = FastAPI(lifespan=lifespan)
+    cache = ResultCache(
+        namespace=json.dumps(
+            {
+                "backend": ENGINE_BACKEND,
+                "model": MODEL,
+                "guided_decoding_backend": GUIDED_DECODING_BACKEND,
+                "min_pixels": MIN_PIXELS,
+                "max_pixels": MAX_PIXELS,
+                "resize": RESIZE_DIMENSIONS,
+                "system_prompt": DEFAULT_SYSTEM_PROMPT,
+                "user_prompt": DEFAULT_ALL_USER_PROMPT
+                if ONE_SHOT
+                else DEFAULT_USER_PROMPT,
+                "int_coords": INT_COORDS,
+                "substructures": SUBSTRUCTURE_INFO,
+                "sampling": SAMPLING_KWARGS,
+                "schemas": JSON_SCHEMAS,
+            },
+            sort_keys=True,
+        ),
+        max_size=RESULT_CACHE_SIZE,
+        # stub points are never real labels, so keep them off the shared volume
+        disk_path=RESULT_CACHE_PATH
+        if RESULT_CACHE_DISK and ENGINE_BACKEND != "stub"
+        else None,
     )
+    inflight = SingleFlight()
+    admission = Admission(
+        ADMISSION_MAX_ACTIVE, ADMISSION_MAX_QUEUE, ADMISSION_SERVICE_SECONDS
+    )
+
+    metrics = Metrics()
 
-    sampling_params = SamplingParams(
-        temperature=TEMPERATURE,
-        top_p=TOP_P,
-        repetition_penalty=REPEATION_PENALTY,
-        stop_token_ids=STOP_TOKEN_IDS,
-        max_tokens=MAX_TOKENS,
-        guided_decoding=GuidedDecodingParams(json=JSON_STRUCTURE),
+    def upload_rejected(path: str, status_code: int):
+        """Count rejections made before a route runs; unknown paths share one series."""
+        routes = {route.path for route in f_app.routes}
+        route = path if path in routes else "other"
+        metrics.inc("requests_total", route=route, status=status_code)
+
+    f_app.add_middleware(
+        UploadLimitMiddleware,
+        max_bytes=UPLOAD_MAX_BYTES,
+        path_limits={"/batch": BATCH_MAX_BYTES},
+        on_reject=upload_rejected,
     )
 
+    def observe_stage(stage: str, seconds: float, substructure: str = "all"):
+        metrics.observe(
+            "stage_seconds", seconds, stage=stage, substructure=substructure
+        )
+
+    def report(
+        progress: Progress, size: tuple[int, int], i: int, completion: Completion
+    ):
+        """Record one completion's stages and tokens, then publish its points."""
+        substructure = SUBSTRUCTURE_NAMES[i]
+        for stage in STAGES:
+            seconds = getattr(completion, f"{stage}_seconds")
+            if seconds is not None:
+                observe_stage(stage, seconds, substructure)
+                progress.timings[stage] = max(progress.timings.get(stage, 0), seconds)
+        for kind in ["prompt", "image", "output"]:
+            metrics.inc(
+                "tokens_total",
+                getattr(completion, f"{kind}_tokens"),
+                kind=kind,
+                substructure=substructure,
+            )
+        start = time.perf_counter()
+        try:
+            parsed = scale_points(
+                parse_outputs([completion.text]), size, int_coords=INT_COORDS
+            )
+        except ValueError:
+            parsed = None  # surfaced by the final parse
+        observe_stage("parse", time.perf_counter() - start, substructure)
+        if parsed is not None:
+            progress.add(parsed)
+
+    async def generate(
+        key: str, img_bytes: bytes, request_id: str, progress: Progress
+    ) -> dict:
+        # decode + resize to the model's frame off the event loop
+        start = time.perf_counter()
+        image, size = await asyncio.to_thread(load_image, img_bytes)
+        progress.timings["preprocess"] = time.perf_counter() - start
+        observe_stage("preprocess", progress.timings["preprocess"])
+        completions = await engine.achat(
+            build_conversations(
+                image,
+                one_shot=ONE_SHOT,
+                int_coords=INT_COORDS,
+            ),
+            request_id,
+            schemas=JSON_SCHEMAS,
+            on_output=partial(report, progress, size),
+        )
+        try:
+            dict_outputs = scale_points(
+                parse_outputs([c.text for c in completions]),
+                size,
+                int_coords=INT_COORDS,
+            )
+        except ValueError as e:
+            msg = str(e)
+            print(msg)
+            raise HTTPException(status_code=500, detail=msg)
+        cache.put(key, dict_outputs)
+        return dict_outputs
+
+    async def admit(
+        key: str,
+        img_bytes: bytes,
+        request_id: str,
+        deadline: float,
+        fail_fast: bool = True,
+        timings: dict[str, float] = None,
+    ) -> tuple[asyncio.Task, Progress]:
+        """Join the in-flight generation for `key`, or queue to start one."""
+        fn = partial(generate, key, img_bytes, request_id)
+        if key in inflight.inflight:
+            return inflight.join(key, fn)  # coalesced: needs no slot of its own
+        try:
+            waited = await admission.acquire(deadline, fail_fast)
+        except HTTPException as e:
+            metrics.inc("admission_rejected_total", status=e.status_code)
+            raise
+        observe_stage("admission", waited)
+        if timings is not None:
+            timings["admission"] = waited
+        if key in inflight.inflight:  # started by another caller while we waited
+            admission.release()
+            return inflight.join(key, fn)
+        start = time.monotonic()
+        task, progress = inflight.join(key, fn)
+        task.add_done_callback(
+            lambda t: admission.release(
+                None if t.cancelled() else time.monotonic() - start
+            )
+        )
+        return task, progress
+
+    async def label(
+        img_bytes: bytes,
+        request_id: str,
+        deadline: float,
+        fail_fast: bool = True,
+        timings: dict[str, float] = None,
+    ) -> dict:
+        """Cached, coalesced, admitted generation for one validated image."""
+        key = cache.key(img_bytes)
+        dict_outputs = cache.get(key)
+        if dict_outputs is not None:
+            print(f"request {request_id} served from cache")
+            return dict_outputs
+        # share the work with identical in-flight uploads
+        task, progress = await admit(
+            key, img_bytes, request_id, deadline, fail_fast, timings
+        )
+        try:
+            # shield so one caller going away doesn't cancel the others' result
+            dict_outputs = await asyncio.wait_for(
+                asyncio.shield(task), max(0.0, deadline - time.monotonic())
+            )
+        except TimeoutError:
+            metrics.inc("abandoned_total", reason="deadline")
+            raise HTTPException(status_code=504, detail="Deadline exceeded")
+        except asyncio.CancelledError:
+            metrics.inc("abandoned_total", reason="disconnect")
+            raise
+        finally:
+            inflight.leave(task, progress)  # last one out cancels the generation
+        if timings is not None:
+            timings.update(progress.timings)
+        return dict_outputs
+
+    async def stream_label(
+        dict_outputs: dict | None,
+        task: asyncio.Task = None,
+        progress: Progress = None,
+        deadline: float = None,
+    ):
+        """Yield NDJSON lines: one per substructure as it completes (or from the
+        cached result), then the full result. The response leaves `task`."""
+        if dict_outputs is None:
+            try:
+                async for partial_outputs in progress.follow(task, deadline):
+                    for name, points in partial_outputs.items():
+                        yield json.dumps({"name": name, "points": points}) + "\n"
+                dict_outputs = await asyncio.shield(task)
+            except TimeoutError:
+                metrics.inc("abandoned_total", reason="deadline")
+                yield json.dumps({"error": "Deadline exceeded"}) + "\n"
+                return
+            except HTTPException as e:
+                yield json.dumps({"error": e.detail}) + "\n"
+                return
+            except asyncio.CancelledError:  # client went away mid-stream
+                metrics.inc("abandoned_total", reason="disconnect")
+                raise
+        else:
+            for name, points in dict_outputs.items():
+                yield json.dumps({"name": name, "points": points}) + "\n"
+        yield json.dumps({"result": dict_outputs}) + "\n"
+
+    def validated(response: dict, timings: dict[str, float], start: float):
+        """Record validation stages; count and raise on rejection."""
+        timings["validate"] = time.perf_counter() - start
+        for stage in ["validate", "scan"]:
+            if stage in timings:
+                observe_stage(stage, timings[stage])
+        if "error" in response.keys():
+            status_code = response.get("status_code", 400)
+            metrics.inc("requests_total", route="/", status=status_code)
+            msg = str(response["error"])
+            print(msg)
+            raise HTTPException(
+                status_code=status_code,
+                detail=msg,
+                headers={"Server-Timing": server_timing(timings)},
+            )
+
     @f_app.post("/")
-    async def main(image_file: UploadFile) -> dict[str, list[list[int]]]:
+    async def main(
+        request: Request,
+        image_file: UploadFile,
+        http_response: Response,
+        stream: bool = False,
+        x_request_timeout: float = Header(default=None),
+    ) -> dict[str, list[list[int | float]]]:  # ints with INT_COORDS
         start = time.monotonic_ns()
+        # callers may ask for a tighter deadline than the server's
+        deadline = time.monotonic() + min(
+            x_request_timeout or REQUEST_DEADLINE_SECONDS, REQUEST_DEADLINE_SECONDS
+        )
         request_id = uuid4()
         print(f"Generating response to request {request_id}")
 
-        response = validate_image_file(image_file)
-        if "error" in response.keys():
-            msg = response["error"]
-            print(msg)
-            raise HTTPException(status_code=400, detail=msg)
+        timings = {}
+        validate_start = time.perf_counter()
+        response = await asyncio.to_thread(validate_image_file, image_file, timings)
+        validated(response, timings, validate_start)
 
         ## send to model
-        base64_img = list(response.values())[0]
-        image_url = f"data:image/jpeg;base64,{base64_img}"
-        dict_outputs = {}
-        for substructure, info in SUBSTRUCTURE_INFO.items():
-            conversation = [
-                {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": DEFAULT_USER_PROMPT.format(
-                                substructure=substructure,
-                                min=info["min"],
-                                max=info["max"],
-                            ),
-                        },
-                        {"type": "image_url", "image_url": {"url": image_url}},
-                    ],
-                },
-            ]
-            outputs = llm.chat(conversation, sampling_params)
-            outputs = [out.outputs[0].text.strip() for out in outputs][0]
-            try:
-                new_outputs = json.loads(outputs)
-            except Exception:
-                msg = f"Failed to parse output: {outputs}"
-                print(msg)
-                raise HTTPException(status_code=500, detail=msg)
-            name = new_outputs["name"]
-            closest = name
-            if name not in SUBSTRUCTURE_INFO.keys():
-                closest = get_close_matches(
-                    name,
-                    SUBSTRUCTURE_INFO.keys(),
-                    n=len(SUBSTRUCTURE_INFO.keys()),
-                    cutoff=0,
-                )[0]
-                print(f"Pred name: {name}, closest name: {closest}")
-            dict_outputs[closest] = [[p["x"], p["y"]] for p in new_outputs["points"]]
+        img_bytes = list(response.values())[0]
+        try:
+            if stream:
+                key = cache.key(img_bytes)
+                dict_outputs = cache.get(key)
+                task = progress = leave = None
+                if dict_outputs is None:  # admit before committing to a 200
+                    task, progress = await admit(
+                        key, img_bytes, str(request_id), deadline, timings=timings
+                    )
+                    leave = partial(inflight.leave, task, progress)
+                metrics.inc("requests_total", route="/", status=200)
+                return LeavingStreamingResponse(
+                    stream_label(dict_outputs, task, progress, deadline),
+                    leave=leave,
+                    media_type="application/x-ndjson",
+                    headers={"Server-Timing": server_timing(timings)},
+                )
+            dict_outputs = await cancel_on_disconnect(
+                request, label(img_bytes, str(request_id), deadline, timings=timings)
+            )
+        except HTTPException as e:
+            metrics.inc("requests_total", route="/", status=e.status_code)
+            raise
+        metrics.inc("requests_total", route="/", status=200)
+        timings["total"] = (time.monotonic_ns() - start) / 1e9
+        http_response.headers["Server-Timing"] = server_timing(timings)
 
         ## print response
         print(
@@ -177,11 +928,140 @@ def get_app():  # noqa: C901
 
         return dict_outputs
 
+    @f_app.post("/batch")
+    async def batch(image_files: list[UploadFile]) -> StreamingResponse:
+        """
+        Label many images (or zip/tar archives of images) in one request.
+
+        All images are scheduled on the engine together, up to
+        BATCH_MAX_INFLIGHT at a time, and one NDJSON line is streamed per image
+        as soon as it finishes, in completion order.
+        """
+        batch_id = uuid4()
+        print(f"Generating responses to batch {batch_id}")
+
+        async def label_one(
+            i: int, filename: str, img_bytes: bytes, error: str = None
+        ) -> dict:
+            if error is not None:  # rejected while unpacking
+                metrics.inc("images_total", route="/batch", status="error")
+                return {"filename": filename, "error": error}
+            timings = {}
+            start = time.perf_counter()
+            response = await asyncio.to_thread(validate_image_bytes, img_bytes, timings)
+            observe_stage("validate", time.perf_counter() - start)
+            if "scan" in timings:
+                observe_stage("scan", timings["scan"])
+            if "error" in response.keys():
+                metrics.inc("images_total", route="/batch", status="error")
+                return {"filename": filename, "error": str(response["error"])}
+            try:
+                # batch images wait their turn rather than fail fast
+                result = await label(
+                    img_bytes, f"{batch_id}-{i}", time.monotonic() + TIMEOUT, False
+                )
+            except HTTPException as e:
+                metrics.inc("images_total", route="/batch", status="error")
+                return {"filename": filename, "error": e.detail}
+            metrics.inc("images_total", route="/batch", status="ok")
+            return {"filename": filename, "result": result}
+
+        async def stream():
+            start = time.monotonic_ns()
+            results = asyncio.Queue()
+            slots = asyncio.Semaphore(BATCH_MAX_INFLIGHT)
+            running = set()
+
+            async def run_one(i: int, filename: str, img_bytes: bytes, error: str):
+                try:
+                    line = await label_one(i, filename, img_bytes, error)
+                except Exception as e:
+                    line = {"filename": filename, "error": str(e)}
+                finally:
+                    slots.release()
+                await results.put(line)
+
+            async def produce() -> int:
+                images = iter_batch_images(image_files)
+                n_images = 0
+                while True:
+                    await slots.acquire()
+                    item = await asyncio.to_thread(next, images, None)
+                    if item is None:
+                        return n_images
+                    task = asyncio.ensure_future(run_one(n_images, *item))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                    n_images += 1
+
+            producer = asyncio.ensure_future(produce())
+            n_sent = 0
+            try:
+                while not producer.done():
+                    get = asyncio.ensure_future(results.get())
+                    await asyncio.wait(
+                        [get, producer], return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if get.done():
+                        n_sent += 1
+                        yield json.dumps(get.result()) + "\n"
+                    else:
+                        get.cancel()
+                if producer.exception() is not None:
+                    yield json.dumps({"error": str(producer.exception())}) + "\n"
+                    return
+                for _ in range(producer.result() - n_sent):
+                    n_sent += 1
+                    yield json.dumps(await results.get()) + "\n"
+            finally:  # client gone: drop the images nobody will receive
+                producer.cancel()
+                for task in list(running):
+                    task.cancel()
+            print(
+                f"batch {batch_id} of {n_sent} images completed in {round((time.monotonic_ns() - start) / 1e9, 2)} seconds"
+            )
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    @f_app.get("/ready")
+    async def ready() -> dict[str, bool]:
+        if not startup.ready:
+            raise HTTPException(status_code=503, detail="Starting up")
+        return {"ready": True}
+
+    @f_app.get("/startup-report")
+    async def startup_report() -> dict:
+        return startup.report()
+
+    @f_app.get("/cache")
+    async def cache_stats() -> dict[str, int | float]:
+        return {**cache.stats(), **inflight.stats(), **admission.stats()}
+
+    @f_app.get("/metrics")
+    async def get_metrics() -> PlainTextResponse:
+        """Prometheus text format: stage latencies, tokens and cache hit rates."""
+        cache_stats = cache.stats()
+        return PlainTextResponse(
+            metrics.render(
+                {
+                    "result_cache_hit_rate": cache_stats["hit_rate"],
+                    "result_cache_size": cache_stats["size"],
+                    "coalesced_requests": inflight.coalesced,
+                    "inflight_generations": len(inflight.inflight),
+                    **admission.stats(),
+                    "ready": int(startup.ready),
+                    "startup_seconds": startup.report()["total_seconds"],
+                    **SCANNER.stats(),
+                }
+            ),
+            media_type="text/plain; version=0.0.4",
+        )
+
     return f_app
 
 
 @app.function(
-    image=GPU_IMAGE,
+    image=API_IMAGE,
     gpu=GPU_CONFIG,
     volumes=VOLUME_CONFIG,
     secrets=SECRETS,
@@ -212,4 +1092,4 @@ def main():
 
 
 if __name__ == "__main__":
-    uvicorn.run(get_app(), reload=True)
+    uvicorn.run("api:get_app", factory=True)
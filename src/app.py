@@ -1,21 +1,22 @@
 import csv
+import hashlib
 import io
 import json
 import os
+import re
 import tempfile
+import threading
 import uuid
-from asyncio import sleep
-from base64 import b64decode, b64encode
+from asyncio import Queue, get_running_loop, wait_for
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from io import BytesIO
 from pathlib import Path
 
 import modal
-import numpy as np
 import requests
 from fasthtml import common as fh
-from matplotlib import pyplot as plt
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 from simpleicons.icons import si_github
 from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import StreamingResponse
@@ -29,7 +30,7 @@ from utils import (
     PYTHON_VERSION,
     SECRETS,
     VOLUME_CONFIG,
-    validate_image_base64,
+    UploadLimitMiddleware,
     validate_image_file,
 )
 
@@ -46,7 +47,6 @@ IMAGE = (
     )
     .pip_install(  # add Python dependencies
         "fastapi>=0.115.8",
-        "matplotlib>=3.10.0",
         "python-fasthtml>=0.12.4",
         "simpleicons>=7.21.0",
         "starlette>=0.45.3",
@@ -55,7 +55,7 @@ IMAGE = (
         "pydantic>=2.10.6",
     )
     .add_local_file(PARENT_PATH / "favicon.ico", "/root/favicon.ico")
-    .add_local_dir(ARTIFACTS_PATH, "/artifacts")
+    .add_local_dir(ARTIFACTS_PATH, "/artifacts", ignore=["cache"])  # not caches
 )
 
 TIMEOUT = 5 * MINUTES  # max
@@ -68,26 +68,189 @@ app = modal.App(f"{APP_NAME}-frontend")
 # -----------------------------------------------------------------------------
 
 
-def display_labels(g) -> str:
-    plt.figure()
-    image = Image.open(BytesIO(b64decode(g.input_image)))
-    plt.imshow(np.array(image.convert("RGB")))
-    plt.axis("off")
-    response = json.loads(g.response)
-    for label, points in response.items():
-        width, height = image.size
-        scale_x, scale_y = width / 800, height / 600
-        x, y = zip(*points)
-        x = [coord * scale_x for coord in x]
-        y = [coord * scale_y for coord in y]
-        plt.plot(x, y, "o", label=label)
-    plt.legend()
+LABEL_COLORS = [  # matplotlib's default cycle, so overlays look as before
+    "#1f77b4",
+    "#ff7f0e",
+    "#2ca02c",
+    "#d62728",
+    "#9467bd",
+    "#8c564b",
+    "#e377c2",
+    "#7f7f7f",
+    "#bcbd22",
+    "#17becf",
+]
+MAX_OVERLAYS = 256  # rendered thumbnail overlays kept in memory
+KEEPALIVE_SECONDS = 15  # comment line on idle SSE connections
+THUMBNAIL_SIZE = (480, 480)  # cards show at most 240px, so 2x for hi-dpi
+BLOB_CACHE_CONTROL = "private, max-age=31536000, immutable"  # keyed by content
+
+
+def display_labels(image: Image.Image, response: str, scale: float = 1.0) -> bytes:
+    """Draw each substructure's points, scaled from image coordinates, and a
+    legend straight onto a copy of `image`."""
+    image = image.convert("RGB")
+    draw = ImageDraw.Draw(image)
+    radius = max(2, round(min(image.size) / 120))
+    font = ImageFont.load_default(size=max(10, 4 * radius))
+    legend = []
+    for i, (label, points) in enumerate(json.loads(response).items()):
+        color = LABEL_COLORS[i % len(LABEL_COLORS)]
+        for x, y in points:
+            x, y = x * scale, y * scale
+            draw.ellipse(
+                (x - radius, y - radius, x + radius, y + radius),
+                fill=color,
+                outline="white",
+            )
+        legend.append((label, color))
+
+    if legend:
+        pad, line = radius, round(font.size * 1.25)
+        width = max(draw.textlength(label, font=font) for label, _ in legend)
+        right = image.width - pad
+        left = right - width - 3 * pad - 2 * radius
+        draw.rectangle(
+            (left, pad, right, pad + line * len(legend) + pad),
+            fill="white",
+            outline="#cccccc",
+        )
+        for i, (label, color) in enumerate(legend):
+            cy = 2 * pad + line * i + line // 2
+            cx = left + pad + radius
+            draw.ellipse(
+                (cx - radius, cy - radius, cx + radius, cy + radius), fill=color
+            )
+            draw.text(
+                (cx + 2 * radius, cy), label, fill="black", font=font, anchor="lm"
+            )
+
     buf = io.BytesIO()
-    plt.savefig(buf, format="png", bbox_inches="tight", pad_inches=0)
-    buf.seek(0)
-    out_image_src = f"data:image/png;base64,{b64encode(buf.getvalue()).decode('utf-8')}"
-    plt.close()
-    return out_image_src
+    image.save(buf, format="png")
+    return buf.getvalue()
+
+
+class BlobStore:
+    """Images stored once under their SHA-256, with thumbnails made on first
+    request, so rows and queries never carry image bytes.
+
+    Without `path`, blobs go in a container-local temporary directory removed
+    with the store, so they live exactly as long as the in-memory db whose
+    rows are their only references."""
+
+    def __init__(self, path: Path = None):
+        if path is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix=f"{APP_NAME}-blobs-")
+            path = Path(self.tmp_dir.name)
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def locate(self, key: str, suffix: str = "") -> Path | None:
+        if not re.fullmatch(r"[0-9a-f]{64}", key):  # keys are never paths
+            return None
+        return self.path / key[:2] / f"{key}{suffix}"
+
+    def write(self, path: Path, save):
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+        save(tmp_path)
+        os.replace(tmp_path, path)  # readers never see a partial file
+
+    def put(self, img_bytes: bytes) -> str:
+        key = hashlib.sha256(img_bytes).hexdigest()
+        path = self.locate(key)
+        if not path.exists():
+            self.write(path, lambda tmp_path: tmp_path.write_bytes(img_bytes))
+        return key
+
+    def read(self, key: str) -> bytes:
+        return self.locate(key).read_bytes()
+
+    def delete(self, key: str):
+        for suffix in ("", ".thumb.png"):
+            if path := self.locate(key, suffix):
+                path.unlink(missing_ok=True)
+
+    def thumbnail(self, key: str) -> Path | None:
+        path = self.locate(key)
+        if path is None or not path.exists():
+            return None
+        thumb_path = self.locate(key, ".thumb.png")
+        if not thumb_path.exists():
+            image = Image.open(path).convert("RGB")
+            image.thumbnail(THUMBNAIL_SIZE)
+            self.write(thumb_path, lambda tmp_path: image.save(tmp_path, format="png"))
+        return thumb_path
+
+
+class OverlayCache:
+    """LRU of final responses drawn on their image's thumbnail, by generation
+    id, each tagged with the response it was drawn from since ids are reused."""
+
+    def __init__(self, blobs: BlobStore, max_size: int = MAX_OVERLAYS):
+        self.blobs = blobs
+        self.max_size = max_size
+        self.overlays = OrderedDict()  # id -> (response, png bytes)
+        self.lock = threading.Lock()
+
+    def get(self, g) -> bytes:
+        with self.lock:
+            entry = self.overlays.get(g.id)
+            if entry and entry[0] == g.response:
+                self.overlays.move_to_end(g.id)
+                return entry[1]
+        return self.put(g)
+
+    def put(self, g) -> bytes:
+        thumb = Image.open(self.blobs.thumbnail(g.image_hash))
+        png = display_labels(thumb, g.response, scale=thumb.width / g.width)
+        with self.lock:
+            self.overlays[g.id] = (g.response, png)
+            self.overlays.move_to_end(g.id)
+            while len(self.overlays) > self.max_size:
+                self.overlays.popitem(last=False)
+        return png
+
+    def discard(self, *ids: int):
+        with self.lock:
+            for id in ids:
+                self.overlays.pop(id, None)
+
+
+class Notifier:
+    """Fans generation updates out to each session's open SSE connections.
+
+    Publishers are worker threads, so ids are handed to each subscriber's
+    queue on that subscriber's event loop."""
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)  # session id -> [(loop, queue)]
+        self.lock = threading.Lock()
+
+    def subscribe(self, session_id: str) -> Queue:
+        queue = Queue()
+        with self.lock:
+            self.subscribers[session_id].append((get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, session_id: str, queue: Queue):
+        with self.lock:
+            subscribers = [
+                sub for sub in self.subscribers[session_id] if sub[1] is not queue
+            ]
+            if subscribers:
+                self.subscribers[session_id] = subscribers
+            else:
+                del self.subscribers[session_id]
+
+    def publish(self, session_id: str, id: int):
+        with self.lock:
+            subscribers = list(self.subscribers.get(session_id, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, id)
+            except RuntimeError:  # loop closed under a dying connection
+                continue
 
 
 def get_app():  # noqa: C901
@@ -158,6 +321,7 @@ def get_app():  # noqa: C901
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    f_app.add_middleware(UploadLimitMiddleware)  # reject oversize uploads early
 
     ## db
     db = fh.database(":memory:")
@@ -168,17 +332,58 @@ def get_app():  # noqa: C901
             session_id=str,
             request_at=datetime,
             filename=str,
-            input_image=str,  # base64
+            image_hash=str,  # blob key, set once the upload passed validation
+            width=int,
+            height=int,
+            done=bool,  # response is final
             response=str,  # json
             failed=bool,
             pk="id",
         )
+    gens.create_index(["session_id", "id"], if_not_exists=True)  # every query
+    gens.create_index(["image_hash", "session_id"], if_not_exists=True)  # blob refs
     Gen = gens.dataclass()
 
+    def session_where(session, before: int = None) -> tuple[str, list]:
+        """Bound filter for the session's rows, older than `before` if given."""
+        where, where_args = "session_id = ?", [session["session_id"]]
+        if before is not None:  # keyset: served by the (session_id, id) index
+            where += " and id < ?"
+            where_args.append(before)
+        return where, where_args
+
+    def session_gens(session, before: int = None, limit: int = None) -> list:
+        where, where_args = session_where(session, before)
+        return gens(where=where, where_args=where_args, order_by="id desc", limit=limit)
+
+    def count_gens(session, before: int = None) -> int:
+        return gens.count_where(*session_where(session, before))
+
     ## SSE state
     shutdown_event = fh.signal_shutdown()
-    global shown_generations
-    shown_generations = {}
+    notifier = Notifier()
+
+    ## images, stored once by content on container-local disk
+    blobs = BlobStore()
+    default_images = [blobs.put(path.read_bytes()) for path in DEFAULT_IMG_PATHS]
+    blobs_lock = threading.Lock()  # a blob is never dropped while a row is added
+
+    def can_see_image(session, key: str) -> bool:
+        return key in default_images or bool(
+            gens.count_where(
+                "image_hash = ? and session_id = ?", [key, session["session_id"]]
+            )
+        )
+
+    def release_images(keys):
+        """Drop the blobs and thumbnails no remaining generation refers to."""
+        with blobs_lock:
+            for key in set(keys) - set(default_images):
+                if not gens.count_where("image_hash = ?", [key]):
+                    blobs.delete(key)
+
+    ## overlays, drawn once per final response
+    overlays = OverlayCache(blobs)
 
     ## pagination
     max_gens = 3
@@ -195,12 +400,10 @@ def get_app():  # noqa: C901
         if not gens[g.id]:
             fh.add_toast(session, "Please refresh the page", "error")
             return None
-        image_src = None
-        response = validate_image_base64(g.input_image)
-        if "error" in response.keys():
-            fh.add_toast(session, response["error"], "error")
+        if not g.image_hash:  # validated once at upload, never re-scanned here
+            fh.add_toast(session, "Image was not validated", "error")
             return None
-        image_src = f"data:image/png;base64,{g.input_image}"
+        image_src = f"/images/{g.image_hash}/thumb"
 
         if g.failed:
             return fh.Card(
@@ -231,6 +434,8 @@ def get_app():  # noqa: C901
                 fh.Div(
                     fh.Img(
                         src=image_src,
+                        width=g.width,
+                        height=g.height,
                         alt="Card image",
                         cls="max-h-48 max-w-48 md:max-h-60 md:max-w-60 object-contain",
                     ),
@@ -272,14 +477,12 @@ def get_app():  # noqa: C901
                 fh.Div(
                     fh.Img(
                         src=image_src,
+                        width=g.width,
+                        height=g.height,
                         alt="Card image",
                         cls="max-h-48 max-w-48 md:max-h-60 md:max-w-60 object-contain",
                     ),
-                    fh.Img(
-                        src=display_labels(g),
-                        alt="Card image",
-                        cls="max-h-48 max-w-48 md:max-h-60 md:max-w-60 object-contain",
-                    ),
+                    gen_result(g),
                     cls="w-5/6 flex flex-col md:flex-row justify-evenly gap-4 items-center",
                 ),
                 cls="w-full flex justify-between items-center p-4",
@@ -313,23 +516,45 @@ def get_app():  # noqa: C901
             fh.Div(
                 fh.Img(
                     src=image_src,
+                    width=g.width,
+                    height=g.height,
                     alt="Card image",
                     cls="max-h-48 max-w-48 md:max-h-60 md:max-w-60 object-contain",
                 ),
-                fh.P(
-                    "Loading...",
-                    hx_ext="sse",
-                    sse_connect=f"/stream-gens/{g.id}",
-                    sse_swap="UpdateGens",
-                ),
+                gen_result(g),
                 cls="w-5/6 flex flex-col md:flex-row justify-evenly gap-4 items-center",
             ),
             cls="w-full flex justify-between items-center p-4",
             id=f"gen-{g.id}",
         )
 
+    def gen_state(g: Gen) -> tuple:
+        return (g.failed, g.done, g.response)
+
+    def gen_result(g: Gen):
+        """What a card shows right of the input; listens for updates until final."""
+        listen = {"sse_swap": f"gen-{g.id}", "hx_swap": "outerHTML"}
+        if g.failed:
+            return fh.P("Failed to scan image", cls="text-red-300")
+        if g.done:
+            # ids are reused, and one response can label different images
+            version = hashlib.sha256(
+                f"{g.image_hash}:{g.response}".encode()
+            ).hexdigest()[:16]
+            return fh.Img(
+                src=f"/gens/{g.id}/overlay?v={version}",
+                width=g.width,
+                height=g.height,
+                alt="Card image",
+                cls="max-h-48 max-w-48 md:max-h-60 md:max-w-60 object-contain",
+            )
+        if g.response:  # partial: name what is found, draw once when final
+            found = ", ".join(json.loads(g.response))
+            return fh.P(f"Found {found}...", **listen)
+        return fh.P("Loading...", **listen)
+
     def num_gens(session, hx_swap_oob: bool = "false"):
-        n_gens = len(gens(where=f"session_id='{session['session_id']}'"))
+        n_gens = count_gens(session)
         return fh.Div(
             fh.P(
                 f"({n_gens} total generations)",
@@ -341,7 +566,7 @@ def get_app():  # noqa: C901
         )
 
     def gen_manage(session, gens_selected: bool = False, hx_swap_oob: bool = "false"):
-        gens_present = len(gens(where=f"session_id='{session['session_id']}'")) > 0
+        gens_present = count_gens(session) > 0
         return fh.Div(
             fh.Button(
                 "Delete selected",
@@ -382,22 +607,20 @@ def get_app():  # noqa: C901
 
     def gen_load_more(
         session,
-        idx: int = 2,
         hx_swap_oob: str = "false",
     ):
-        n_gens = len(gens(where=f"session_id='{session['session_id']}'"))
-        gens_present = n_gens > 0
-        still_more = n_gens > len(shown_generations)
+        last_id = session.get("last_gen_id")  # oldest card on the page
+        still_more = last_id is not None and count_gens(session, last_id) > 0
         return fh.Div(
             fh.Button(
                 "Load More",
-                hx_get=f"/page-gens?idx={idx}",
+                hx_get=f"/page-gens?last_id={last_id}",
                 hx_indicator="#spinner",
                 hx_target="#gen-list",
                 hx_swap="beforeend",
                 cls="text-blue-300 hover:text-blue-100 p-2 border-blue-300 border-2 hover:border-blue-100 w-full h-full",
             )
-            if gens_present and still_more
+            if still_more
             else None,
             id="load-more-gens",
             hx_swap_oob=hx_swap_oob if hx_swap_oob != "false" else None,
@@ -502,7 +725,7 @@ def get_app():  # noqa: C901
                 *[
                     fh.A(
                         fh.Img(
-                            src=f"data:image/png;base64,{b64encode(open(img_path, 'rb').read()).decode('utf-8')}",
+                            src=f"/images/{key}/thumb",
                             alt=f"Image {i+1}",
                             cls="w-full h-auto object-contain hover:cursor-pointer hover:opacity-100 opacity-50",
                         ),
@@ -518,7 +741,9 @@ def get_app():  # noqa: C901
                             }
                         ),
                     )
-                    for i, img_path in enumerate(DEFAULT_IMG_PATHS)
+                    for i, (img_path, key) in enumerate(
+                        zip(DEFAULT_IMG_PATHS, default_images)
+                    )
                 ],
                 cls="w-full md:w-2/3 grid grid-cols-2 md:grid-cols-4 gap-4",
             ),
@@ -528,6 +753,8 @@ def get_app():  # noqa: C901
                 fh.Div(
                     get_gen_table_part(session),
                     id="gen-list",
+                    hx_ext="sse",
+                    sse_connect="/stream-gens",  # one connection for every card
                     cls="w-full flex flex-col gap-2",
                 ),
                 cls="w-full md:w-2/3 flex flex-col gap-4 justify-center items-center",
@@ -576,59 +803,79 @@ def get_app():  # noqa: C901
                 files={
                     "image_file": open(path, "rb"),
                 },
+                params={"stream": "true"},
+                stream=True,
                 timeout=api_timeout,
             )
             if not response.ok:
                 raise Exception(f"Failed with status code: {response.status_code}")
-            g.response = response.json()
+            # show each substructure as soon as the API finishes it
+            partial_response = {}
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                message = json.loads(line)
+                if "error" in message:
+                    raise Exception(message["error"])
+                if "result" in message:
+                    partial_response = message["result"]
+                else:
+                    partial_response[message["name"]] = message["points"]
+                g.response = json.dumps(partial_response)
+                gens.update(g)
+                notifier.publish(g.session_id, g.id)
+            if not partial_response:
+                raise Exception("Empty response")
+            g.done = True
+            overlays.put(g)  # draw before views can see it
         except Exception as e:
             print(e)
             fh.add_toast(session, "Failed with error: " + str(e), "error")
             g.failed = True
         gens.update(g)
+        notifier.publish(g.session_id, g.id)
 
     ## SSE helpers
+    def gen_update(g: Gen, shown: dict) -> str | None:
+        """An SSE message swapping in a card's new result, unless this
+        connection already sent it. Cards that stopped listening ignore it."""
+        if shown.get(g.id) == gen_state(g):
+            return None
+        shown[g.id] = gen_state(g)
+        return fh.sse_message(gen_result(g), event=f"gen-{g.id}")
+
     async def stream_gen_updates(
         session,
-        id: int,
     ):
-        while not shutdown_event.is_set():
-            g = gens[id]
-            if g:
-                curr_state = (
-                    "response" if g.response else "failed" if g.failed else "loading"
+        session_id = session["session_id"]
+        queue = notifier.subscribe(session_id)
+        shown = {}  # id -> last state sent on this connection
+        try:
+            # catch up on anything that changed before this connection opened
+            for g in session_gens(session):
+                if message := gen_update(g, shown):
+                    yield message
+            while not shutdown_event.is_set():
+                try:
+                    id = await wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                found = gens(
+                    where="id = ? and session_id = ?", where_args=[id, session_id]
                 )
-                global shown_generations
-                if shown_generations.get(id) != curr_state:
-                    shown_generations[id] = curr_state
-                    yield f"""event: UpdateGens\ndata: {fh.to_xml(
-                    fh.P(
-                        "Loading...",
-                        sse_swap="UpdateGens",
-                    ) if curr_state == "loading" else
-                    fh.Img(
-                        src=display_labels(g),
-                        alt="Card image",
-                        cls="max-h-48 max-w-48 md:max-h-60 md:max-w-60 object-contain",
-                    ) if curr_state == "response" else
-                    fh.P(
-                        "Failed to scan image",
-                        cls="text-red-300",
-                        sse_swap="UpdateGens",
-                    ))}\n\n"""
-            await sleep(1)
+                if found and (message := gen_update(found[0], shown)):
+                    yield message
+        finally:
+            notifier.unsubscribe(session_id, queue)
 
     ## pagination
-    def get_gen_table_part(session, part_num: int = 1, size: int = max_gens):
-        offset = (part_num - 1) * size
-        next_gens = gens(
-            where=f"session_id='{session['session_id']}'", offset=offset, limit=size
-        )
-        global shown_generations
-        for g in next_gens:
-            shown_generations[g.id] = (
-                "response" if g.response else "failed" if g.failed else "loading"
-            )
+    def get_gen_table_part(session, last_id: int = None, size: int = max_gens):
+        next_gens = session_gens(session, before=last_id, limit=size)
+        if next_gens:  # keyset cursor for the next page
+            session["last_gen_id"] = next_gens[-1].id
+        elif last_id is None:
+            session.pop("last_gen_id", None)
         paginated = [gen_view(g, session) for g in next_gens]
         return tuple(paginated)
 
@@ -672,11 +919,48 @@ def get_app():  # noqa: C901
             ),
         )
 
-    @f_app.get("/stream-gens/{id}")
-    async def stream_gens(session, id: int):
-        """Stream generation updates to connected clients"""
+    ## images
+    @f_app.get("/images/{key}")
+    def image(session, key: str):
+        path = blobs.locate(key)
+        if path is None or not path.exists() or not can_see_image(session, key):
+            return fh.Response(status_code=404)
+        return fh.FileResponse(
+            path,
+            media_type=Image.MIME[Image.open(path).format],  # header only
+            headers={"Cache-Control": BLOB_CACHE_CONTROL},
+        )
+
+    @f_app.get("/images/{key}/thumb")
+    def image_thumb(session, key: str):
+        if not can_see_image(session, key):
+            return fh.Response(status_code=404)
+        path = blobs.thumbnail(key)
+        if path is None:
+            return fh.Response(status_code=404)
+        return fh.FileResponse(
+            path, media_type="image/png", headers={"Cache-Control": BLOB_CACHE_CONTROL}
+        )
+
+    @f_app.get("/gens/{gen_id}/overlay")
+    def gen_overlay(session, gen_id: int):
+        found = gens(
+            where="id = ? and session_id = ? and done",
+            where_args=[gen_id, session["session_id"]],
+        )
+        if not found:
+            return fh.Response(status_code=404)
+        return fh.Response(
+            overlays.get(found[0]),
+            media_type="image/png",
+            headers={"Cache-Control": BLOB_CACHE_CONTROL},  # versioned by response
+        )
+
+    @f_app.get("/stream-gens")
+    async def stream_gens(session):
+        """Stream every generation update in the session over one connection"""
         return StreamingResponse(
-            stream_gen_updates(session, id), media_type="text/event-stream"
+            stream_gen_updates(session), media_type="text/event-stream"
         )
 
     ## input validation
@@ -692,13 +976,10 @@ def get_app():  # noqa: C901
 
     ## pagination
     @f_app.get("/page-gens")
-    def page_gens(session, idx: int):
-        next_gens = get_gen_table_part(
-            session, idx
-        )  # separate to modify global shown_generations
+    def page_gens(session, last_id: int):
+        next_gens = get_gen_table_part(session, last_id)
         return next_gens, gen_load_more(
             session,
-            idx + 1,
             "true",
         )
 
@@ -729,17 +1010,21 @@ def get_app():  # noqa: C901
         )
 
         # create generation for instant display, fill later
-        g = Gen(
-            session_id=session["session_id"],
-            request_at=datetime.now(),
-            filename=str(image_file.filename),
-            input_image=list(response.values())[0],
-            response="",
-            failed=False,
-        )
-        g = gens.insert(g)
-        global shown_generations
-        shown_generations[g.id] = "loading"
+        img_bytes = list(response.values())[0]
+        width, height = Image.open(BytesIO(img_bytes)).size  # header only
+        with blobs_lock:
+            g = Gen(
+                session_id=session["session_id"],
+                request_at=datetime.now(),
+                filename=str(image_file.filename),
+                image_hash=blobs.put(img_bytes),
+                width=width,
+                height=height,
+                response="",
+                failed=False,
+                done=False,
+            )
+            g = gens.insert(g)
         generate_and_save(g, image_file, session)
         return (
             gen_view(g, session),
@@ -757,10 +1042,12 @@ def get_app():  # noqa: C901
     def delete_gens(
         session,
     ):
-        for gen in gens(where=f"session_id='{session['session_id']}'"):
-            gens.delete(gen.id)
-        global shown_generations
-        shown_generations = {}
+        deleted = session_gens(session)
+        ids = [g.id for g in deleted]
+        gens.delete_where("session_id = ?", [session["session_id"]])
+        overlays.discard(*ids)
+        release_images(g.image_hash for g in deleted)
+        session.pop("last_gen_id", None)
         fh.add_toast(session, "Deleted generations.", "success")
         return (
             "",
@@ -778,17 +1065,21 @@ def get_app():  # noqa: C901
     @f_app.delete("/gens/select")
     def delete_select_gens(session, selected_gens: list[int] = None):
         if selected_gens:
-            for id in selected_gens:
-                gens.delete(id)
-            global shown_generations
-            shown_generations = {
-                k: v for k, v in shown_generations.items() if k not in selected_gens
-            }
+            where = "session_id = ? and id in ({})".format(
+                ", ".join("?" * len(selected_gens))
+            )
+            where_args = [session["session_id"], *selected_gens]
+            deleted = gens(where=where, where_args=where_args)
+            gens.delete_where(where, where_args)
+            overlays.discard(*selected_gens)
+            release_images(g.image_hash for g in deleted)
             fh.add_toast(session, "Deleted generations.", "success")
-            remain_view = [
-                gen_view(g, session)
-                for g in gens(where=f"session_id='{session['session_id']}'")[::-1]
-            ]
+            remaining = session_gens(session)
+            if remaining:  # every remaining card is now on the page
+                session["last_gen_id"] = remaining[-1].id
+            else:
+                session.pop("last_gen_id", None)
+            remain_view = [gen_view(g, session) for g in remaining]
             return (
                 remain_view,
                 num_gens(session, "true"),
@@ -825,9 +1116,11 @@ def get_app():  # noqa: C901
         session,
         gen_id: int,
     ):
-        gens.delete(gen_id)
-        global shown_generations
-        shown_generations.pop(gen_id, None)
+        where, where_args = "id = ? and session_id = ?", [gen_id, session["session_id"]]
+        deleted = gens(where=where, where_args=where_args)
+        gens.delete_where(where, where_args)
+        overlays.discard(gen_id)
+        release_images(g.image_hash for g in deleted)
         fh.add_toast(session, "Deleted generation.", "success")
         return (
             "",
@@ -848,7 +1141,10 @@ def get_app():  # noqa: C901
         req,
     ):
         session = req.session
-        if not gens(where=f"session_id='{session['session_id']}'"):
+        session_rows = gens(
+            where="session_id = ?", where_args=[session["session_id"]], order_by="id"
+        )
+        if not session_rows:
             return fh.Response(status_code=204)
 
         output = io.StringIO()
@@ -858,18 +1154,22 @@ def get_app():  # noqa: C901
                 "session_id",
                 "request_at",
                 "filename",
-                "image_b64",
+                "image_hash",
+                "width",
+                "height",
                 "response",
                 "failed",
             ]
         )
-        for g in gens(where=f"session_id='{session['session_id']}'"):
+        for g in session_rows:
             writer.writerow(
                 [
                     g.session_id,
                     g.request_at,
                     g.filename,
-                    g.input_image,
+                    g.image_hash,
+                    g.width,
+                    g.height,
                     g.response,
                     g.failed,
                 ]
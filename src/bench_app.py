@@ -0,0 +1,146 @@
+"""Time website renders for one session holding many generations."""
+
+import csv
+import io
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import median
+
+from starlette.testclient import TestClient
+
+from utils import DEFAULT_IMG_PATHS, SUBSTRUCTURE_INFO
+
+# -----------------------------------------------------------------------------
+
+# bench config
+
+N_GENS = 100
+N_ROUNDS = 5
+API_PORT = 8766
+RESULT = {  # stands in for the API's answer, in image coordinates: every
+    # substructure with its most points, the largest answer the schemas allow
+    substructure: [[100.0 + 80.5 * j, 60.0 + 70.25 * i] for j in range(info["max"])]
+    for i, (substructure, info) in enumerate(SUBSTRUCTURE_INFO.items())
+}
+
+# -----------------------------------------------------------------------------
+
+# helpers
+
+
+class FakeAPI(BaseHTTPRequestHandler):
+    """Answers every scan at once, so only the website is timed."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = (json.dumps({"result": RESULT}) + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def timed(fn, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    response = fn(*args, **kwargs)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def page_through(client: TestClient) -> float:
+    """Follow the Load More cursor from the home page to the last page."""
+    seconds, html = 0.0, client.get("/").text
+    while match := re.search(r'hx-get="/page-gens\?last_id=(\d+)"', html):
+        start = time.perf_counter()
+        response = client.get(
+            "/page-gens",
+            params={"last_id": match[1]},
+            headers={"HX-Request": "true"},  # fragment, as htmx asks for it
+        )
+        response.raise_for_status()
+        seconds += time.perf_counter() - start
+        html = response.text
+    return seconds
+
+
+def wait_for_gens(client: TestClient, n: int, timeout: float = 60.0):
+    """Block until every generation in the session has a response or failed."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        rows = list(csv.DictReader(io.StringIO(client.get("/export-gens").text)))
+        if len(rows) == n and all(
+            row["response"] or row["failed"] == "True" for row in rows
+        ):
+            return
+        time.sleep(0.1)
+    raise TimeoutError(f"{n} generations did not finish within {timeout} seconds")
+
+
+# -----------------------------------------------------------------------------
+
+# main
+
+
+def main(n_gens: int = N_GENS, n_rounds: int = N_ROUNDS):
+    server = ThreadingHTTPServer(("127.0.0.1", API_PORT), FakeAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["API_URL"] = f"http://127.0.0.1:{API_PORT}"
+
+    from app import f_app  # builds the website's db on import
+
+    with TestClient(f_app) as client:
+        client.get("/")  # start the session
+        upload_seconds = [
+            timed(
+                client.post,
+                "/upload",
+                data={"image_path": str(DEFAULT_IMG_PATHS[i % len(DEFAULT_IMG_PATHS)])},
+            )
+            for i in range(n_gens)
+        ]
+        wait_for_gens(client, n_gens)
+
+        home_seconds, page_seconds, delete_seconds, card_seconds = [], [], [], []
+        for i in range(n_rounds):
+            home_seconds.append(timed(client.get, "/"))
+            page_seconds.append(page_through(client))
+            delete_seconds.append(  # re-renders every remaining card
+                timed(
+                    client.request,
+                    "DELETE",
+                    "/gens/select",
+                    data={"selected_gens": str(i + 1)},
+                )
+            )
+            card_seconds.append(delete_seconds[-1] / max(1, n_gens - i - 1))
+    server.shutdown()
+
+    def ms(seconds: float) -> str:
+        return f"{round(seconds * 1000, 2)} ms"
+
+    print(f"{n_gens} generations, median of {n_rounds} rounds")
+    print(f"upload: {ms(median(upload_seconds))} per image")
+    print(f"home page: {ms(median(home_seconds))}")
+    print(f"all pages: {ms(median(page_seconds))}")
+    print(
+        f"delete one, re-render the rest: {ms(median(delete_seconds))} "
+        f"({ms(median(card_seconds))} per card)"
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gens", type=int, default=N_GENS)
+    parser.add_argument("--rounds", type=int, default=N_ROUNDS)
+    args = parser.parse_args()
+    main(args.gens, args.rounds)
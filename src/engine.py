@@ -0,0 +1,575 @@
+"""Inference backends shared by the API and eval."""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from dataclasses import dataclass
+from functools import partial
+
+from PIL import Image
+
+from utils import (
+    JSON_STRUCTURE,
+    PROCESSOR,
+    RESIZE_DIMENSIONS,
+    SUBSTRUCTURE_INFO,
+    IntPoint,
+    IntSubstructure,
+    IntSubstructures,
+    Point,
+    Substructure,
+    Substructures,
+)
+
+# -----------------------------------------------------------------------------
+
+# config
+
+ENGINE_BACKEND = os.getenv("ENGINE_BACKEND", "vllm")  # "vllm" or "stub"
+# V1's xgrammar rejects the schemas' numeric and array bounds with no fallback
+GUIDED_DECODING_BACKEND = os.getenv("GUIDED_DECODING_BACKEND", "guidance")
+
+STUB_LATENCY_MEAN = float(os.getenv("STUB_LATENCY_MEAN", "1.0"))  # seconds per batch
+STUB_LATENCY_STD = float(os.getenv("STUB_LATENCY_STD", "0.25"))  # seconds per batch
+STUB_SEED = 42
+STUB_PREFILL_FRACTION = 0.2  # share of stub latency reported as prefill
+
+IMAGE_TOKEN = "<|image_pad|>"
+IMAGE_PATCH = 28  # pixels per image token side (14px patches merged 2x2)
+
+# -----------------------------------------------------------------------------
+
+# engines
+
+
+def conversation_images(conversation: list[dict]) -> list[Image.Image]:
+    return [
+        c["image"]
+        for m in conversation
+        if isinstance(m["content"], list)
+        for c in m["content"]
+        if c["type"] == "image"
+    ]
+
+
+def build_prompt(processor, conversation: list[dict]) -> dict:
+    """Apply the chat template and attach the conversation's decoded image(s)."""
+    text = processor.apply_chat_template(
+        conversation, tokenize=False, add_generation_prompt=True
+    )
+    images = conversation_images(conversation)
+    prompt = {"prompt": text}
+    if images:
+        prompt["multi_modal_data"] = {
+            "image": images[0] if len(images) == 1 else images
+        }
+    return prompt
+
+
+def image_digest(image: Image.Image) -> str:
+    return hashlib.sha256(image.tobytes()).hexdigest()
+
+
+@dataclass
+class Completion:
+    """One conversation's output text plus where its tokens and seconds went."""
+
+    text: str
+    prompt_tokens: int = 0
+    image_tokens: int = 0
+    output_tokens: int = 0
+    queue_seconds: float = None  # None when the engine can't tell
+    prefill_seconds: float = None
+    decode_seconds: float = None
+
+
+def image_token_id(processor) -> int:
+    return processor.tokenizer.convert_tokens_to_ids(IMAGE_TOKEN)
+
+
+def to_completion(
+    out,
+    image_token: int,
+    submitted: float = None,
+    first_token: float = None,
+    finished: float = None,
+) -> Completion:
+    """
+    Build a `Completion` from a vLLM `RequestOutput`.
+
+    Stage times come from vLLM's request metrics when it records them;
+    otherwise prefill and decode are split at the first streamed output, with
+    prefill including any time spent queued.
+    """
+    prompt_token_ids = out.prompt_token_ids or []
+    completion = Completion(
+        text=out.outputs[0].text.strip(),
+        prompt_tokens=len(prompt_token_ids),
+        image_tokens=sum(t == image_token for t in prompt_token_ids),
+        output_tokens=len(out.outputs[0].token_ids),
+    )
+    metrics = getattr(out, "metrics", None)
+    if metrics is not None and getattr(metrics, "first_token_time", None):
+        scheduled = metrics.first_scheduled_time or metrics.arrival_time
+        completion.queue_seconds = scheduled - metrics.arrival_time
+        completion.prefill_seconds = metrics.first_token_time - scheduled
+        completion.decode_seconds = (
+            metrics.finished_time or metrics.last_token_time
+        ) - metrics.first_token_time
+    elif None not in (submitted, first_token, finished):
+        completion.prefill_seconds = first_token - submitted
+        completion.decode_seconds = finished - first_token
+    return completion
+
+
+def enable_v1_for_prefix_caching(llm_kwargs: dict):
+    """vLLM's V1 engine keys cached blocks on image hashes, so cached image
+    prefixes are only reused for the same image. Must run before importing vllm."""
+    if llm_kwargs.get("enable_prefix_caching"):
+        os.environ.setdefault("VLLM_USE_V1", "1")
+
+
+class Engine(ABC):
+    """Generates one completion per chat conversation."""
+
+    @abstractmethod
+    def chat(
+        self,
+        conversations: list[list[dict]],
+        use_tqdm: bool = False,
+        schemas: list[dict] = None,
+    ) -> list[Completion]: ...
+
+    async def agenerate(
+        self, conversation: list[dict], request_id: str, schema: dict = None
+    ) -> Completion:
+        return (
+            await self.achat(
+                [conversation], request_id, None if schema is None else [schema]
+            )
+        )[0]
+
+    async def achat(
+        self,
+        conversations: list[list[dict]],
+        request_id: str,
+        schemas: list[dict] = None,
+        on_output: Callable[[int, Completion], None] = None,
+    ) -> list[Completion]:
+        """
+        Default: run the blocking batch off the event loop.
+
+        `on_output(i, completion)` is called as each conversation's completion
+        is done, so callers can stream partial results. Cancelling only stops
+        the wait: a batch already running in the thread runs to completion.
+        """
+        outputs = await asyncio.to_thread(self.chat, conversations, False, schemas)
+        if on_output is not None:
+            for i, output in enumerate(outputs):
+                on_output(i, output)
+        return outputs
+
+    def warmup(self):
+        """Compile guided-decoding grammars before the first request."""
+
+    async def awarmup(self):
+        await asyncio.to_thread(self.warmup)
+
+
+class GuidedSamplingParams:
+    """
+    Guided-decoding SamplingParams built once per JSON schema.
+
+    Schemas passed at startup are built (and later compiled) up front; any other
+    schema is built on first use and reused after that.
+    """
+
+    WARMUP_PROMPT = "{"
+
+    def __init__(
+        self, sampling_kwargs: dict, default_schema: dict, schemas: list[dict] = ()
+    ):
+        from vllm import SamplingParams
+        from vllm.sampling_params import GuidedDecodingParams
+
+        self.SamplingParams = SamplingParams
+        self.GuidedDecodingParams = GuidedDecodingParams
+        self.sampling_kwargs = sampling_kwargs
+        self.default_schema = default_schema
+        self.params = {}
+        self.schemas = [default_schema, *schemas]
+        for schema in self.schemas:
+            self.get(schema)
+
+    def get(self, schema: dict = None, **overrides):
+        schema = self.default_schema if schema is None else schema
+        key = (json.dumps(schema, sort_keys=True), tuple(sorted(overrides.items())))
+        if key not in self.params:
+            self.params[key] = self.SamplingParams(
+                **{**self.sampling_kwargs, **overrides},
+                guided_decoding=self.GuidedDecodingParams(json=schema),
+            )
+        return self.params[key]
+
+    def warmup_params(self) -> list:
+        """One-token requests that force every startup schema to compile."""
+        return [self.get(schema, max_tokens=1) for schema in self.schemas]
+
+
+class VLLMEngine(Engine):
+    """
+    vLLM offline engine with JSON guided decoding.
+
+    With prefix caching, one conversation per image is prefilled before the
+    batch so the rest of the batch reuses its cached system + image prefix
+    instead of all prefilling it in the same step.
+    """
+
+    def __init__(
+        self,
+        llm_kwargs: dict,
+        sampling_kwargs: dict,
+        json_schema: dict = JSON_STRUCTURE,
+        json_schemas: list[dict] = (),
+    ):
+        enable_v1_for_prefix_caching(llm_kwargs)
+        from transformers import AutoProcessor
+        from vllm import LLM, SamplingParams
+
+        self.llm = LLM(**llm_kwargs)
+        self.processor = AutoProcessor.from_pretrained(
+            llm_kwargs.get("tokenizer", PROCESSOR)
+        )
+        self.image_token = image_token_id(self.processor)
+        self.sampling_params = GuidedSamplingParams(
+            sampling_kwargs, json_schema, json_schemas
+        )
+        self.prefix_caching = llm_kwargs.get("enable_prefix_caching", False)
+        self.prefill_params = SamplingParams(max_tokens=1)
+        self.lock = threading.Lock()  # LLM is not safe to call concurrently
+
+    def chat(
+        self,
+        conversations: list[list[dict]],
+        use_tqdm: bool = False,
+        schemas: list[dict] = None,
+    ) -> list[Completion]:
+        params = [
+            self.sampling_params.get(schema)
+            for schema in (schemas or [None] * len(conversations))
+        ]
+        prompts = [
+            build_prompt(self.processor, conversation) for conversation in conversations
+        ]
+        with self.lock:
+            if self.prefix_caching and len(conversations) > 1:
+                firsts = {}
+                for conversation, prompt in zip(conversations, prompts):
+                    images = tuple(map(id, conversation_images(conversation)))
+                    firsts.setdefault(images, prompt)
+                self.llm.generate(
+                    list(firsts.values()), self.prefill_params, use_tqdm=False
+                )
+            outputs = self.llm.generate(prompts, params, use_tqdm=use_tqdm)
+        return [to_completion(out, self.image_token) for out in outputs]
+
+    def warmup(self):
+        params = self.sampling_params.warmup_params()
+        with self.lock:
+            self.llm.generate(
+                [GuidedSamplingParams.WARMUP_PROMPT] * len(params),
+                params,
+                use_tqdm=False,
+            )
+
+
+class AsyncVLLMEngine(Engine):
+    """
+    vLLM async engine with continuous batching.
+
+    Every conversation is submitted as its own engine request, so prompts
+    from concurrent API requests are scheduled together as they arrive. With
+    prefix caching, the first conversation of a request is admitted alone and
+    the rest follow once its prefill is done, so they hit its cached prefix.
+
+    The blocking `chat` and `warmup` run on a private event loop in a daemon
+    thread. vLLM ties its output handling to the loop that first generates,
+    so use either the blocking or the async methods on one engine, not both.
+    """
+
+    def __init__(
+        self,
+        llm_kwargs: dict,
+        sampling_kwargs: dict,
+        json_schema: dict = JSON_STRUCTURE,
+        json_schemas: list[dict] = (),
+    ):
+        enable_v1_for_prefix_caching(llm_kwargs)
+        from transformers import AutoProcessor
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+        self.engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**llm_kwargs))
+        self.processor = AutoProcessor.from_pretrained(
+            llm_kwargs.get("tokenizer", PROCESSOR)
+        )
+        self.image_token = image_token_id(self.processor)
+        self.sampling_params = GuidedSamplingParams(
+            sampling_kwargs, json_schema, json_schemas
+        )
+        self.prefix_caching = llm_kwargs.get("enable_prefix_caching", False)
+        self.loop = None  # private, started by the first blocking call
+        self.loop_lock = threading.Lock()
+        self.chat_ids = itertools.count()
+
+    def run_blocking(self, coro):
+        """Run `coro` on the private loop and wait for its result."""
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        task = None
+
+        async def tracked():
+            nonlocal task
+            task = asyncio.current_task()
+            return await coro
+
+        future = asyncio.run_coroutine_threadsafe(tracked(), self.loop)
+        try:
+            return future.result()
+        except BaseException:  # e.g. KeyboardInterrupt: abort the engine requests
+            if task is None:
+                future.cancel()
+            else:  # the future ignores `cancel` once running
+                self.loop.call_soon_threadsafe(task.cancel)
+            raise
+
+    async def run(self, prompt, params, request_id: str, prefilled=None) -> Completion:
+        submitted, first_token, final = time.monotonic(), None, None
+        try:
+            async for out in self.engine.generate(prompt, params, request_id):
+                final = out
+                if first_token is None:
+                    first_token = time.monotonic()
+                if prefilled is not None:
+                    prefilled.set()
+        except asyncio.CancelledError:
+            await self.engine.abort(request_id)  # free its KV cache blocks now
+            raise
+        return to_completion(
+            final, self.image_token, submitted, first_token, time.monotonic()
+        )
+
+    async def agenerate(
+        self,
+        conversation: list[dict],
+        request_id: str,
+        schema: dict = None,
+        prefilled: asyncio.Event = None,
+    ) -> Completion:
+        prompt = build_prompt(self.processor, conversation)
+        return await self.run(
+            prompt, self.sampling_params.get(schema), request_id, prefilled
+        )
+
+    async def achat(
+        self,
+        conversations: list[list[dict]],
+        request_id: str,
+        schemas: list[dict] = None,
+        on_output: Callable[[int, Completion], None] = None,
+    ) -> list[Completion]:
+        schemas = schemas or [None] * len(conversations)
+        tasks = []
+        try:
+            for i, (conversation, schema) in enumerate(zip(conversations, schemas)):
+                prefilled = asyncio.Event() if self.prefix_caching and i == 0 else None
+                task = asyncio.ensure_future(
+                    self.agenerate(conversation, f"{request_id}-{i}", schema, prefilled)
+                )
+                if on_output is not None:
+                    task.add_done_callback(partial(self.report, on_output, i))
+                tasks.append(task)
+                if prefilled is not None:
+                    # first output token => shared prefix is in the cache
+                    waiter = asyncio.ensure_future(prefilled.wait())
+                    await asyncio.wait(
+                        [tasks[0], waiter], return_when=asyncio.FIRST_COMPLETED
+                    )
+                    waiter.cancel()
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    @staticmethod
+    def report(
+        on_output: Callable[[int, Completion], None], i: int, task: asyncio.Task
+    ):
+        if not task.cancelled() and task.exception() is None:
+            on_output(i, task.result())
+
+    def chat(
+        self,
+        conversations: list[list[dict]],
+        use_tqdm: bool = False,
+        schemas: list[dict] = None,
+    ) -> list[Completion]:
+        return self.run_blocking(
+            self.achat(conversations, f"chat-{next(self.chat_ids)}", schemas)
+        )
+
+    def warmup(self):
+        self.run_blocking(self.awarmup())
+
+    async def awarmup(self):
+        await asyncio.gather(
+            *(
+                self.run(
+                    {"prompt": GuidedSamplingParams.WARMUP_PROMPT},
+                    params,
+                    f"warmup-{i}",
+                )
+                for i, params in enumerate(self.sampling_params.warmup_params())
+            )
+        )
+
+
+class StubEngine(Engine):
+    """
+    CPU stand-in for the vLLM engine.
+
+    Sleeps for a log-normally distributed latency per batch, then returns
+    schema-valid `Substructure` (or one-shot `Substructures`) JSON. Outputs are
+    a pure function of the conversation so repeated calls give identical
+    responses.
+    """
+
+    def __init__(
+        self,
+        latency_mean: float = STUB_LATENCY_MEAN,
+        latency_std: float = STUB_LATENCY_STD,
+        seed: int = STUB_SEED,
+    ):
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.rng = random.Random(seed)
+
+    def latency(self) -> float:
+        if self.latency_mean <= 0:
+            return 0.0
+        if self.latency_std <= 0:
+            return self.latency_mean
+        # log-normal with the requested mean and std
+        sigma2 = math.log(1 + (self.latency_std / self.latency_mean) ** 2)
+        mu = math.log(self.latency_mean) - sigma2 / 2
+        return self.rng.lognormvariate(mu, math.sqrt(sigma2))
+
+    def complete(self, conversation: list[dict], seconds: float = 0.0) -> Completion:
+        """Schema-valid output plus plausible token counts and stage times."""
+        output = self.output(conversation)
+        image_tokens = sum(
+            (image.width // IMAGE_PATCH) * (image.height // IMAGE_PATCH)
+            for image in conversation_images(conversation)
+        )
+        text = json.dumps(conversation, default=lambda _: "")
+        return Completion(
+            text=output,
+            prompt_tokens=image_tokens + len(text) // 4,
+            image_tokens=image_tokens,
+            output_tokens=len(output) // 4,
+            queue_seconds=0.0,
+            prefill_seconds=seconds * STUB_PREFILL_FRACTION,
+            decode_seconds=seconds * (1 - STUB_PREFILL_FRACTION),
+        )
+
+    def output(self, conversation: list[dict]) -> str:
+        key = json.dumps(conversation, sort_keys=True, default=image_digest).encode()
+        rng = random.Random(hashlib.sha256(key).hexdigest())
+        text = "".join(
+            c["text"]
+            for m in conversation
+            if isinstance(m["content"], list)
+            for c in m["content"]
+            if c["type"] == "text"
+        )
+        int_coords = '"x": int' in text  # integer-coordinate prompt
+        if "Detect the following substructures" in text:  # one-shot prompt
+            substructures = [
+                self.substructure(name, rng, int_coords) for name in SUBSTRUCTURE_INFO
+            ]
+            return (IntSubstructures if int_coords else Substructures)(
+                **{s.name: s.model_dump()["points"] for s in substructures}
+            ).model_dump_json()
+        match = re.search(r"Detect the (.+?) substructure", text)
+        name = match.group(1) if match else rng.choice(list(SUBSTRUCTURE_INFO))
+        return self.substructure(name, rng, int_coords).model_dump_json()
+
+    def substructure(
+        self, name: str, rng: random.Random, int_coords: bool = False
+    ) -> Substructure | IntSubstructure:
+        info = SUBSTRUCTURE_INFO.get(name, {"min": 1, "max": 1})
+        ndigits = None if int_coords else 2
+        points = [
+            (IntPoint if int_coords else Point)(
+                x=round(rng.uniform(0, RESIZE_DIMENSIONS[0]), ndigits),
+                y=round(rng.uniform(0, RESIZE_DIMENSIONS[1]), ndigits),
+            )
+            for _ in range(rng.randint(info["min"], info["max"]))
+        ]
+        return (IntSubstructure if int_coords else Substructure)(
+            name=name, points=points
+        )
+
+    def chat(
+        self,
+        conversations: list[list[dict]],
+        use_tqdm: bool = False,
+        schemas: list[dict] = None,
+    ) -> list[Completion]:
+        latency = self.latency()
+        time.sleep(latency)
+        return [self.complete(conversation, latency) for conversation in conversations]
+
+    async def achat(
+        self,
+        conversations: list[list[dict]],
+        request_id: str,
+        schemas: list[dict] = None,
+        on_output: Callable[[int, Completion], None] = None,
+    ) -> list[Completion]:
+        latency = self.latency()
+        if on_output is None:
+            await asyncio.sleep(latency)
+            return [
+                self.complete(conversation, latency) for conversation in conversations
+            ]
+        # spread the batch latency over the outputs so streaming is observable
+        outputs = []
+        for i, conversation in enumerate(conversations):
+            await asyncio.sleep(latency / len(conversations))
+            outputs.append(
+                self.complete(conversation, latency * (i + 1) / len(conversations))
+            )
+            on_output(i, outputs[-1])
+        return outputs
+
+
+def get_engine(
+    backend: str = ENGINE_BACKEND, asynchronous: bool = False, **kwargs
+) -> Engine:
+    if backend == "vllm":
+        return AsyncVLLMEngine(**kwargs) if asynchronous else VLLMEngine(**kwargs)
+    if backend == "stub":
+        return StubEngine()
+    raise ValueError(f"Unknown engine backend: {backend}")
@@ -17,13 +17,14 @@ from utils import (
     APP_NAME,
     CPU,
     DATA_VOL_PATH,
-    DEFAULT_USER_PROMPT,
     GPU_IMAGE,
     MEM,
     MINUTES,
     SPLITS,
     SUBSTRUCTURE_INFO,
     VOLUME_CONFIG,
+    format_all_user_prompt,
+    format_user_prompt,
 )
 
 # -----------------------------------------------------------------------------
@@ -139,7 +140,14 @@ def process_xcf(url: str, i: int):
     return names_to_points, i
 
 
-def write_sft_json(json_path: Path, xcfs: list):
+def format_point(point, int_coords: bool = False) -> dict:
+    """Label point as written to the SFT data: whole pixels or full precision."""
+    if int_coords:
+        return {"x": round(float(point[0])), "y": round(float(point[1]))}
+    return {"x": float(point[0]), "y": float(point[1])}
+
+
+def write_sft_json(json_path: Path, xcfs: list, int_coords: bool = False):
     with open(json_path, "w") as f:
         json.dump(
             [
@@ -147,7 +155,7 @@ def write_sft_json(json_path: Path, xcfs: list):
                     "conversations": [
                         {
                             "from": "human",
-                            "value": f"<image>{DEFAULT_USER_PROMPT.format(substructure=substructure, min=SUBSTRUCTURE_INFO[substructure]['min'], max=SUBSTRUCTURE_INFO[substructure]['max'])}",
+                            "value": f"<image>{format_user_prompt(substructure, int_coords)}",
                         },
                         {
                             "from": "gpt",
@@ -155,7 +163,7 @@ def write_sft_json(json_path: Path, xcfs: list):
                                 {
                                     "name": substructure,
                                     "points": [
-                                        {"x": float(point[0]), "y": float(point[1])}
+                                        format_point(point, int_coords)
                                         for point in list(points)
                                     ],
                                 }
@@ -173,10 +181,48 @@ def write_sft_json(json_path: Path, xcfs: list):
         )
 
 
+def write_sft_all_json(json_path: Path, xcfs: list, int_coords: bool = False):
+    """One sample per image with every substructure labelled, answered as the
+    one-shot schema: each substructure's points keyed by its name."""
+    with open(json_path, "w") as f:
+        json.dump(
+            [
+                {
+                    "conversations": [
+                        {
+                            "from": "human",
+                            "value": f"<image>{format_all_user_prompt(int_coords)}",
+                        },
+                        {
+                            "from": "gpt",
+                            "value": json.dumps(
+                                {
+                                    substructure: [
+                                        format_point(point, int_coords)
+                                        for point in list(xcf[0][substructure])
+                                    ]
+                                    for substructure in SUBSTRUCTURE_INFO
+                                }
+                            ),
+                        },
+                    ],
+                    "images": [str(DATA_VOL_PATH / f"{xcf[1]}.png")],
+                }
+                for xcf in xcfs
+                if all(  # every property is required
+                    len(xcf[0].get(substructure, [])) > 0
+                    for substructure in SUBSTRUCTURE_INFO
+                )
+            ],
+            f,
+            indent=4,
+        )
+
+
 # -----------------------------------------------------------------------------
 
 
-def main(sft: bool, dpo: bool):
+def main(sft: bool, dpo: bool, one_shot: bool = False, int_coords: bool = False):
     if not sft and not dpo:
         raise ValueError("Must specify at least one of `sft` or `dpo`")
 
@@ -228,6 +274,12 @@ def main(sft: bool, dpo: bool):
         )
         for split, xcfs in zip(SPLITS, [train, val, test]):
             write_sft_json(DATA_VOL_PATH / f"sft_{split}.json", xcfs)
+            if one_shot:
+                write_sft_all_json(DATA_VOL_PATH / f"sft_all_{split}.json", xcfs)
+            if int_coords:  # same splits, whole-pixel labels
+                write_sft_json(
+                    DATA_VOL_PATH / f"sft_int_{split}.json", xcfs, int_coords=True
+                )
 
     if dpo:
         pass
@@ -240,13 +292,18 @@ def main(sft: bool, dpo: bool):
     volumes=VOLUME_CONFIG,
     timeout=TIMEOUT,
 )
-def run(sft: bool, dpo: bool):
-    main(sft, dpo)
+def run(sft: bool, dpo: bool, one_shot: bool, int_coords: bool):
+    main(sft, dpo, one_shot, int_coords)
 
 
 @app.local_entrypoint()
-def local(sft: bool = False, dpo: bool = False):
-    run.remote(sft, dpo)
+def local(
+    sft: bool = False,
+    dpo: bool = False,
+    one_shot: bool = False,
+    int_coords: bool = False,
+):
+    run.remote(sft, dpo, one_shot, int_coords)
 
 
 if __name__ == "__main__":
@@ -255,5 +312,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--sft", action="store_true")
     parser.add_argument("--dpo", action="store_true")
+    parser.add_argument("--one-shot", action="store_true")
+    parser.add_argument("--int-coords", action="store_true")
     args = parser.parse_args()
-    main(args.sft, args.dpo)
+    main(args.sft, args.dpo, args.one_shot, args.int_coords)
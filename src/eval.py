@@ -1,42 +1,44 @@
-import base64
 import json
-from difflib import get_close_matches
+import time
+from functools import cache
 from itertools import chain
 from pathlib import Path
 
 import modal
 import numpy as np
-import torch
 import yaml
 from more_itertools import chunked
 from scipy.optimize import linear_sum_assignment
 from scipy.spatial.distance import directed_hausdorff
 from sklearn.metrics import auc, precision_recall_curve, roc_auc_score
 from tqdm import tqdm
-from vllm import LLM, SamplingParams
-from vllm.sampling_params import GuidedDecodingParams
 
+from engine import ENGINE_BACKEND, GUIDED_DECODING_BACKEND, get_engine
 from utils import (
     APP_NAME,
     BASE_HF_MODEL,
     BASE_QUANT_MODEL,
     CPU,
     DATA_VOL_PATH,
-    DEFAULT_SYSTEM_PROMPT,
-    DEFAULT_USER_PROMPT,
     DPO_HF_MODEL,
     DPO_QUANT_MODEL,
     GPU_IMAGE,
-    JSON_STRUCTURE,
     MEM,
     MINUTES,
     PROCESSOR,
     SECRETS,
+    SFT_ALL_HF_MODEL,
     SFT_HF_MODEL,
+    SFT_INT_HF_MODEL,
     SFT_QUANT_MODEL,
     SPLITS,
     SUBSTRUCTURE_INFO,
     VOLUME_CONFIG,
+    build_conversations,
+    build_schemas,
+    load_image,
+    local_gpu_count,
+    parse_outputs,
 )
 
 # -----------------------------------------------------------------------------
@@ -46,6 +48,7 @@ from utils import (
 KV_CACHE_DTYPE = None  # "fp8_e5m2"
 LIMIT_MM_PER_PROMPT = {"image": 1}
 ENFORCE_EAGER = False
+ENABLE_PREFIX_CACHING = True  # prefill system prompt + image once per image
 MAX_NUM_SEQS = 1
 MIN_PIXELS = 28 * 28
 MAX_PIXELS = 1280 * 28 * 28
@@ -64,7 +67,7 @@ MAX_TOKENS = 4096
 TIMEOUT = 24 * 60 * MINUTES
 
 if modal.is_local():
-    GPU_COUNT = torch.cuda.device_count()
+    GPU_COUNT = local_gpu_count()
 else:
     GPU_COUNT = 1
 
@@ -135,6 +138,7 @@ def point_level_metrics(gts, preds, threshold=20.0):
     return {
         "hausdorff_distance": hausdorff,
         "euclidean_distance": euclid_sum,
+        "matched": num_matched,
         "tp": tp,
         "fp": fp,
         "fn": fn,
@@ -300,30 +304,24 @@ def summarize(lbl_pt_metrics):
     }
 
 
-@app.function(
-    image=GPU_IMAGE,
-    cpu=CPU,
-    memory=MEM,
-    gpu=GPU_CONFIG,
-    volumes=VOLUME_CONFIG,
-    secrets=SECRETS,
-    timeout=TIMEOUT,
-)
-def run_model(img_paths: list[Path], model: str, quant: bool) -> list[dict]:
-    # load pretrained vlm if not already loaded
-    if "quantization" not in globals():
-        quantization = "awq_marlin" if quant else None
-    if "llm" not in globals():
-        llm = LLM(
-            model=model,
-            tokenizer=PROCESSOR,
-            limit_mm_per_prompt=LIMIT_MM_PER_PROMPT,
-            enforce_eager=ENFORCE_EAGER,
-            max_num_seqs=MAX_NUM_SEQS,
-            tensor_parallel_size=GPU_COUNT,
-            trust_remote_code=True,
-            max_model_len=MAX_MODEL_LEN,
-            mm_processor_kwargs={
+@cache
+def load_engine(model: str, quant: bool, one_shot: bool, int_coords: bool):
+    """One engine per container, reused by every `run_model` call it serves."""
+    quantization = "awq_marlin" if quant else None
+    return get_engine(
+        ENGINE_BACKEND,
+        llm_kwargs={
+            "model": model,
+            "tokenizer": PROCESSOR,
+            "limit_mm_per_prompt": LIMIT_MM_PER_PROMPT,
+            "enforce_eager": ENFORCE_EAGER,
+            "enable_prefix_caching": ENABLE_PREFIX_CACHING,
+            "guided_decoding_backend": GUIDED_DECODING_BACKEND,
+            "max_num_seqs": MAX_NUM_SEQS,
+            "tensor_parallel_size": GPU_COUNT,
+            "trust_remote_code": True,
+            "max_model_len": MAX_MODEL_LEN,
+            "mm_processor_kwargs": {
                 "min_pixels": MIN_PIXELS,
                 "max_pixels": MAX_PIXELS,
             },
@@ -335,60 +333,59 @@ def run_model(img_paths: list[Path], model: str, quant: bool) -> list[dict]:
                 ]
                 if v is not None
             },
-        )
-    if "sampling_params" not in globals():
-        sampling_params = SamplingParams(
-            temperature=TEMPERATURE,
-            top_p=TOP_P,
-            repetition_penalty=REPEATION_PENALTY,
-            stop_token_ids=STOP_TOKEN_IDS,
-            max_tokens=MAX_TOKENS,
-            guided_decoding=GuidedDecodingParams(json=JSON_STRUCTURE),
-        )
+        },
+        sampling_kwargs={
+            "temperature": TEMPERATURE,
+            "top_p": TOP_P,
+            "repetition_penalty": REPEATION_PENALTY,
+            "stop_token_ids": STOP_TOKEN_IDS,
+            "max_tokens": MAX_TOKENS,
+        },
+        json_schemas=build_schemas(one_shot=one_shot, int_coords=int_coords),
+    )
+
+
+@app.function(
+    image=GPU_IMAGE,
+    cpu=CPU,
+    memory=MEM,
+    gpu=GPU_CONFIG,
+    volumes=VOLUME_CONFIG,
+    secrets=SECRETS,
+    timeout=TIMEOUT,
+)
+def run_model(
+    img_paths: list[Path],
+    model: str,
+    quant: bool,
+    one_shot: bool = False,
+    int_coords: bool = False,
+) -> list[tuple[dict, float, int]]:
+    """Returns (prediction, seconds, output tokens) per image."""
+    engine = load_engine(model, quant, one_shot, int_coords)  # cached per container
 
     preds = []
     for img_path in img_paths:
         with open(img_path, "rb") as image_file:
-            base64_img = base64.b64encode(image_file.read()).decode("utf-8")
-        img_url = f"data:image/jpeg;base64,{base64_img}"
-        dict_outputs = {}
-        for substructure, info in SUBSTRUCTURE_INFO.items():
-            conversation = [
-                {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": DEFAULT_USER_PROMPT.format(
-                                substructure=substructure,
-                                min=info["min"],
-                                max=info["max"],
-                            ),
-                        },
-                        {"type": "image_url", "image_url": {"url": img_url}},
-                    ],
-                },
-            ]
-            outputs = llm.chat(conversation, sampling_params, use_tqdm=True)
-            outputs = [out.outputs[0].text.strip() for out in outputs][0]
-            try:
-                new_outputs = json.loads(outputs)
-            except Exception:
-                print(outputs)
-                raise Exception("Failed to parse output")
-            name = new_outputs["name"]
-            closest = name
-            if name not in SUBSTRUCTURE_INFO.keys():
-                closest = get_close_matches(
-                    name,
-                    SUBSTRUCTURE_INFO.keys(),
-                    n=len(SUBSTRUCTURE_INFO.keys()),
-                    cutoff=0,
-                )[0]
-                print(f"Pred name: {name}, closest name: {closest}")
-            dict_outputs[closest] = [[p["x"], p["y"]] for p in new_outputs["points"]]
-        preds.append(dict_outputs)
+            image, _ = load_image(image_file.read())  # labels are in the 800x600 frame
+        start = time.monotonic()
+        completions = engine.chat(
+            build_conversations(
+                image,
+                one_shot=one_shot,
+                int_coords=int_coords,
+            ),
+            use_tqdm=True,
+            schemas=build_schemas(one_shot=one_shot, int_coords=int_coords),
+        )
+        latency = time.monotonic() - start
+        try:
+            dict_outputs = parse_outputs([c.text for c in completions])
+        except ValueError as e:
+            print(e)
+            raise Exception("Failed to parse output")
+        output_tokens = sum(c.output_tokens for c in completions)
+        preds.append((dict_outputs, latency, output_tokens))
     return preds
 
 
@@ -397,12 +394,46 @@ def run_model(img_paths: list[Path], model: str, quant: bool) -> list[dict]:
 # main
 
 
-def main(base: bool, sft: bool, dpo: bool, quant: bool):
+def summarize_latency(latencies: list[float]) -> dict:
+    return {
+        "mean_s": round(float(np.mean(latencies)), 3),
+        "p50_s": round(float(np.percentile(latencies, 50)), 3),
+        "p95_s": round(float(np.percentile(latencies, 95)), 3),
+    }
+
+
+def summarize_cost(metrics: list[dict], tokens: list[int]) -> dict:
+    """Mean matched-point error (px) against output tokens per image."""
+    point_metrics = [pm for metric in metrics for pm in metric["point_metrics"]]
+    matched = sum(pm["matched"] for pm in point_metrics)
+    error = sum(pm["euclidean_distance"] for pm in point_metrics)
+    return {
+        "mean_point_error_px": round(error / matched, 2) if matched else None,
+        "output_tokens_per_image": round(float(np.mean(tokens)), 1),
+        "output_tokens_per_point": round(sum(tokens) / matched, 2) if matched else None,
+    }
+
+
+def main(
+    base: bool,
+    sft: bool,
+    dpo: bool,
+    quant: bool,
+    one_shot: bool = False,
+    int_coords: bool = False,
+):
     if not base and not sft and not dpo:
         raise ValueError("Must specify at least one of `base`, `sft`, or `dpo`)")
+    if one_shot and sft and quant:
+        raise ValueError("No quantized one-shot SFT model, run without `quant`")
+    if int_coords and (not sft or quant or one_shot):
+        raise ValueError("Integer coordinates need `sft`, without `quant`/`one_shot`")
 
     split_metrics = {}
+    split_latencies = {}
+    split_costs = {}
     for split in SPLITS:
+        # full-precision labels, so integer outputs pay for their rounding
         with open(DATA_VOL_PATH / f"sft_{split}.json", "r") as f:
             read_ds = yaml.safe_load(f)
         img_paths = [sample["images"][0] for sample in read_ds]
@@ -438,11 +469,16 @@ def main(base: bool, sft: bool, dpo: bool, quant: bool):
             if dpo and quant
             else None
         )
+        if one_shot and sft:
+            model = SFT_ALL_HF_MODEL
+        if int_coords:
+            model = SFT_INT_HF_MODEL
         if modal.is_local():
             preds = list(
                 tqdm(
                     chain.from_iterable(
-                        run_model.local(batch, model, quant) for batch in img_batches
+                        run_model.local(batch, model, quant, one_shot, int_coords)
+                        for batch in img_batches
                     ),
                     desc=split,
                     total=len(img_batches),
@@ -450,13 +486,21 @@ def main(base: bool, sft: bool, dpo: bool, quant: bool):
             )
         else:
             lst_preds = run_model.starmap(
-                [(batch, model, quant) for batch in img_batches]
+                [(batch, model, quant, one_shot, int_coords) for batch in img_batches]
             )
             preds = [item for lst in lst_preds for item in lst]
+        preds, latencies, tokens = zip(*preds)
         split_metrics[split] = label_and_point_metrics(labels, preds)
+        split_latencies[split] = summarize_latency(latencies)
+        split_costs[split] = summarize_cost(split_metrics[split], tokens)
 
+    mode = "one-shot" if one_shot else "per-substructure"
+    if int_coords:
+        mode += ", int coords"
     for split, metrics in split_metrics.items():
-        print(f"{split}: {summarize(metrics)}")
+        print(f"{split} ({mode}): {summarize(metrics)}")
+        print(f"{split} ({mode}) latency per image: {split_latencies[split]}")
+        print(f"{split} ({mode}) error vs tokens: {split_costs[split]}")
 
 
 @app.function(
@@ -465,15 +509,22 @@ def main(base: bool, sft: bool, dpo: bool, quant: bool):
     secrets=SECRETS,
     timeout=TIMEOUT,
 )
-def run(base: bool, sft: bool, dpo: bool, quant: bool):
-    main(base, sft, dpo, quant)
+def run(
+    base: bool, sft: bool, dpo: bool, quant: bool, one_shot: bool, int_coords: bool
+):
+    main(base, sft, dpo, quant, one_shot, int_coords)
 
 
 @app.local_entrypoint()
 def local(
-    base: bool = False, sft: bool = False, dpo: bool = False, quant: bool = False
+    base: bool = False,
+    sft: bool = False,
+    dpo: bool = False,
+    quant: bool = False,
+    one_shot: bool = False,
+    int_coords: bool = False,
 ):
-    run.remote(base, sft, dpo, quant)
+    run.remote(base, sft, dpo, quant, one_shot, int_coords)
 
 
 if __name__ == "__main__":
@@ -484,5 +535,7 @@ if __name__ == "__main__":
     parser.add_argument("--sft", action="store_true")
     parser.add_argument("--dpo", action="store_true")
     parser.add_argument("--quant", action="store_true")
+    parser.add_argument("--one-shot", action="store_true")
+    parser.add_argument("--int-coords", action="store_true")
     args = parser.parse_args()
-    main(args.base, args.sft, args.dpo, args.quant)
+    main(args.base, args.sft, args.dpo, args.quant, args.one_shot, args.int_coords)
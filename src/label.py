@@ -0,0 +1,380 @@
+"""Bulk labelling of image folders on Modal workers or local processes."""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import cache
+from pathlib import Path
+
+import modal
+from tqdm import tqdm
+
+from engine import ENGINE_BACKEND, GUIDED_DECODING_BACKEND, get_engine
+from utils import (
+    APP_NAME,
+    GPU_IMAGE,
+    IMAGE_EXTENSIONS,
+    MINUTES,
+    PROCESSOR,
+    SECRETS,
+    SFT_ALL_HF_MODEL,
+    SFT_INT_HF_MODEL,
+    SFT_QUANT_MODEL,
+    SUBSTRUCTURE_INFO,
+    VOLUME_CONFIG,
+    build_conversations,
+    build_schemas,
+    load_image,
+    local_gpu_count,
+    parse_outputs,
+    scale_points,
+)
+
+# -----------------------------------------------------------------------------
+
+# labelling config
+
+SHARD_SIZE = int(os.getenv("LABEL_SHARD_SIZE", "16"))  # images per engine batch
+MAX_INFLIGHT_SHARDS = 2  # per local worker: one running, one queued
+
+# vlm config
+
+KV_CACHE_DTYPE = None  # "fp8_e5m2"
+LIMIT_MM_PER_PROMPT = {"image": 1}
+ENFORCE_EAGER = False
+ENABLE_PREFIX_CACHING = True  # prefill system prompt + image once per image
+MAX_NUM_SEQS = SHARD_SIZE * len(SUBSTRUCTURE_INFO)  # one shard in one batch
+MIN_PIXELS = 28 * 28
+MAX_PIXELS = 1280 * 28 * 28
+TEMPERATURE = 0.0
+TOP_P = 0.001
+REPEATION_PENALTY = 1.05
+STOP_TOKEN_IDS = []
+MAX_MODEL_LEN = 32768
+MAX_TOKENS = 4096
+
+# -----------------------------------------------------------------------------
+
+# Modal
+
+TIMEOUT = 24 * 60 * MINUTES
+MAX_CONTAINERS = 8
+
+if modal.is_local():
+    GPU_COUNT = local_gpu_count()
+else:
+    GPU_COUNT = 1
+
+GPU_TYPE = "l4"
+GPU_CONFIG = f"{GPU_TYPE}:{GPU_COUNT}"
+
+app = modal.App(name=f"{APP_NAME}-label")
+
+# -----------------------------------------------------------------------------
+
+# helpers
+
+
+def list_images(source: Path) -> list[Path]:
+    """Every image under a directory, or every path listed in a manifest file
+    (one per line, relative to the manifest)."""
+    if source.is_dir():
+        return sorted(
+            path
+            for path in source.rglob("*")
+            if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS
+        )
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    return [source.parent / line for line in lines if line and not line.startswith("#")]
+
+
+def load_done(output: Path) -> set[str]:
+    """Content hashes already labelled in `output`, so a rerun resumes.
+
+    Error records and a line cut short by a crash are ignored, so those images
+    are labelled again and a later record for the same hash supersedes them."""
+    done = set()
+    if not output.exists():
+        return done
+    line = ""
+    with open(output) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "result" in record:
+                done.add(record["hash"])
+    if line and not line.endswith("\n"):  # keep the next append on its own line
+        with open(output, "a") as f:
+            f.write("\n")
+    return done
+
+
+def iter_shards(paths: list[Path], done: set[str]):
+    """Yield shards of (path, hash, bytes) for images not yet labelled."""
+    seen = set(done)
+    shard = []
+    for path in paths:
+        img_bytes = path.read_bytes()
+        key = hashlib.sha256(img_bytes).hexdigest()
+        if key in seen:  # already labelled, or a duplicate in this run
+            continue
+        seen.add(key)
+        shard.append((str(path), key, img_bytes))
+        if len(shard) == SHARD_SIZE:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+@cache
+def load_engine(one_shot: bool, int_coords: bool):
+    """One engine per process, reused by every shard it labels."""
+    model = (
+        SFT_ALL_HF_MODEL
+        if one_shot
+        else SFT_INT_HF_MODEL
+        if int_coords
+        else SFT_QUANT_MODEL
+    )
+    quantization = None if one_shot or int_coords else "awq_marlin"
+    return get_engine(
+        ENGINE_BACKEND,
+        llm_kwargs={
+            "model": model,
+            "tokenizer": PROCESSOR,
+            "limit_mm_per_prompt": LIMIT_MM_PER_PROMPT,
+            "enforce_eager": ENFORCE_EAGER,
+            "enable_prefix_caching": ENABLE_PREFIX_CACHING,
+            "guided_decoding_backend": GUIDED_DECODING_BACKEND,
+            "max_num_seqs": MAX_NUM_SEQS,
+            "tensor_parallel_size": GPU_COUNT,
+            "trust_remote_code": True,
+            "max_model_len": MAX_MODEL_LEN,
+            "mm_processor_kwargs": {
+                "min_pixels": MIN_PIXELS,
+                "max_pixels": MAX_PIXELS,
+            },
+            **{
+                k: v
+                for k, v in [
+                    ("quantization", quantization),
+                    ("kv_cache_dtype", KV_CACHE_DTYPE),
+                ]
+                if v is not None
+            },
+        },
+        sampling_kwargs={
+            "temperature": TEMPERATURE,
+            "top_p": TOP_P,
+            "repetition_penalty": REPEATION_PENALTY,
+            "stop_token_ids": STOP_TOKEN_IDS,
+            "max_tokens": MAX_TOKENS,
+        },
+        json_schemas=build_schemas(one_shot=one_shot, int_coords=int_coords),
+    )
+
+
+def label_images(
+    shard: list[tuple[str, str, bytes]],
+    one_shot: bool = False,
+    int_coords: bool = False,
+) -> list[dict]:
+    """Label a shard in one engine batch; one record per image."""
+    engine = load_engine(one_shot, int_coords)
+    schemas = build_schemas(one_shot=one_shot, int_coords=int_coords)
+    records, conversations, sizes = [], [], []
+    for path, key, img_bytes in shard:
+        try:
+            image, size = load_image(img_bytes)
+        except Exception as e:
+            records.append({"hash": key, "path": path, "error": str(e)})
+            continue
+        records.append({"hash": key, "path": path})
+        conversations.extend(
+            build_conversations(
+                image,
+                one_shot=one_shot,
+                int_coords=int_coords,
+            )
+        )
+        sizes.append(size)
+
+    completions = iter(
+        engine.chat(conversations, schemas=schemas * len(sizes)) if sizes else []
+    )
+    sizes = iter(sizes)
+    for record in records:
+        if "error" in record:
+            continue
+        texts = [next(completions).text for _ in schemas]
+        try:
+            record["result"] = scale_points(
+                parse_outputs(texts), next(sizes), int_coords=int_coords
+            )
+        except ValueError as e:
+            record["error"] = str(e)
+    return records
+
+
+@app.function(
+    image=GPU_IMAGE,
+    gpu=GPU_CONFIG,
+    volumes=VOLUME_CONFIG,
+    secrets=SECRETS,
+    timeout=TIMEOUT,
+    max_containers=MAX_CONTAINERS,
+)
+def label_shard(
+    shard: list[tuple[str, str, bytes]], one_shot: bool, int_coords: bool
+) -> list[dict]:
+    return label_images(shard, one_shot, int_coords)
+
+
+def start_workers(workers: int) -> list[ProcessPoolExecutor]:
+    """One single-process pool per worker, each pinned to its own GPU.
+
+    Importing this module queries CUDA, which fixes a process's visible devices,
+    so CUDA_VISIBLE_DEVICES is set here before each worker starts rather than in
+    the worker. Each worker then sees one GPU, so its engine runs with TP=1."""
+    visible = os.getenv("CUDA_VISIBLE_DEVICES")
+    devices = visible.split(",") if visible else [str(i) for i in range(GPU_COUNT)]
+    context = multiprocessing.get_context("spawn")
+    pools = []
+    try:
+        for i in range(workers):
+            if ENGINE_BACKEND == "vllm":
+                os.environ["CUDA_VISIBLE_DEVICES"] = devices[i]
+            pool = ProcessPoolExecutor(max_workers=1, mp_context=context)
+            pool.submit(os.getpid).result()  # start the worker under this device
+            pools.append(pool)
+    finally:  # later workers and this process keep the user's devices
+        if visible is None:
+            os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+        else:
+            os.environ["CUDA_VISIBLE_DEVICES"] = visible
+    return pools
+
+
+def label_locally(shards, workers: int, one_shot: bool, int_coords: bool):
+    """Yield each shard's records as soon as a local worker finishes it."""
+    if ENGINE_BACKEND == "vllm" and workers > GPU_COUNT:
+        print(f"capping {workers} workers at {GPU_COUNT}, one per GPU")
+        workers = GPU_COUNT
+    if workers <= 1:  # one engine across every GPU
+        for shard in shards:
+            yield label_images(shard, one_shot, int_coords)
+        return
+    pools = start_workers(workers)
+    try:
+        pending = {}  # future -> pool running it
+        load = dict.fromkeys(pools, 0)
+        for shard in shards:
+            pool = min(pools, key=load.get)
+            while load[pool] >= MAX_INFLIGHT_SHARDS:  # bound memory
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    load[pending.pop(future)] -= 1
+                    yield future.result()
+                pool = min(pools, key=load.get)
+            pending[pool.submit(label_images, shard, one_shot, int_coords)] = pool
+            load[pool] += 1
+        for future in as_completed(pending):
+            yield future.result()
+    finally:
+        for pool in pools:
+            pool.shutdown(cancel_futures=True)
+
+
+# -----------------------------------------------------------------------------
+
+# main
+
+
+def main(
+    source: Path,
+    output: Path,
+    workers: int = 1,
+    remote: bool = False,
+    one_shot: bool = False,
+    int_coords: bool = False,
+):
+    if one_shot and int_coords:
+        raise ValueError("Pick one of `one_shot` or `int_coords`")
+    paths = list_images(source)
+    done = load_done(output)
+    print(f"{len(paths)} images under {source}, {len(done)} already in {output}")
+
+    shards = iter_shards(paths, done)
+    if remote:
+        results = label_shard.map(
+            shards,
+            kwargs={"one_shot": one_shot, "int_coords": int_coords},
+            order_outputs=False,
+        )
+    else:
+        results = label_locally(shards, workers, one_shot, int_coords)
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    n_labelled = n_errors = 0
+    start = time.monotonic()
+    with open(output, "a") as f, tqdm(unit="img", desc="label") as progress:
+        for records in results:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())  # a finished shard survives preemption
+            n_labelled += len(records)
+            n_errors += sum("error" in record for record in records)
+            progress.update(len(records))
+    seconds = time.monotonic() - start
+    rate = n_labelled / seconds if seconds > 0 else 0.0
+    print(
+        f"labelled {n_labelled} images ({n_errors} errors) in {round(seconds, 2)} seconds: {rate:.2f} images/s"
+    )
+
+
+@app.local_entrypoint()
+def local(
+    source: str,
+    output: str = "labels.jsonl",
+    one_shot: bool = False,
+    int_coords: bool = False,
+):
+    main(
+        Path(source),
+        Path(output),
+        remote=True,
+        one_shot=one_shot,
+        int_coords=int_coords,
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", type=Path, help="image directory or manifest file")
+    parser.add_argument("--output", type=Path, default=Path("labels.jsonl"))
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--one-shot", action="store_true")
+    parser.add_argument("--int-coords", action="store_true")
+    args = parser.parse_args()
+    main(
+        args.source,
+        args.output,
+        args.workers,
+        one_shot=args.one_shot,
+        int_coords=args.int_coords,
+    )
@@ -21,7 +21,11 @@ from utils import (
     MINUTES,
     RUNS_VOL_PATH,
     SECRETS,
+    SFT_ALL_HF_MODEL,
+    SFT_ALL_MODEL,
     SFT_HF_MODEL,
+    SFT_INT_HF_MODEL,
+    SFT_INT_MODEL,
     SFT_MODEL,
     TRAIN_REPO_PATH,
     VOLUME_CONFIG,
@@ -42,6 +46,8 @@ app = modal.App(name=f"{APP_NAME}-train")
 
 ## dataset_info.json
 SFT_DATA = "sft_train.json"
+SFT_ALL_DATA = "sft_all_train.json"
+SFT_INT_DATA = "sft_int_train.json"
 DPO_DATA = "dpo_train.json"
 dataset_info = {
     "sft": {
@@ -49,6 +55,16 @@ dataset_info = {
         "formatting": "sharegpt",
         "columns": {"messages": "conversations", "images": "images"},
     },
+    "sft_all": {
+        "file_name": str(TRAIN_REPO_PATH / "data" / SFT_ALL_DATA),
+        "formatting": "sharegpt",
+        "columns": {"messages": "conversations", "images": "images"},
+    },
+    "sft_int": {
+        "file_name": str(TRAIN_REPO_PATH / "data" / SFT_INT_DATA),
+        "formatting": "sharegpt",
+        "columns": {"messages": "conversations", "images": "images"},
+    },
     "dpo": {
         "file_name": str(TRAIN_REPO_PATH / "data" / DPO_DATA),
         "formatting": "sharegpt",
@@ -142,6 +158,22 @@ sft_config = {
     "run_name": SFT_MODEL,
 }
 
+## one-shot variant: one prompt per image covering every substructure
+sft_all_config = {
+    **sft_config,
+    "dataset": "sft_all",
+    "output_dir": str(RUNS_VOL_PATH / SFT_ALL_MODEL),
+    "run_name": SFT_ALL_MODEL,
+}
+
+## integer-coordinate variant: fewer decode tokens per point
+sft_int_config = {
+    **sft_config,
+    "dataset": "sft_int",
+    "output_dir": str(RUNS_VOL_PATH / SFT_INT_MODEL),
+    "run_name": SFT_INT_MODEL,
+}
+
 # -----------------------------------------------------------------------------
 
 # dpo
@@ -231,9 +263,11 @@ def push_to_hub(local_dir: str, model_path: str):
 # main
 
 
-def main(sft: bool, dpo: bool):
+def main(sft: bool, dpo: bool, one_shot: bool = False, int_coords: bool = False):
     if not sft and not dpo:
         raise ValueError("Must specify at least one of `sft` or `dpo`")
+    if one_shot and int_coords:
+        raise ValueError("Pick one of `one_shot` or `int_coords`")
 
     with open(TRAIN_REPO_PATH / "data/dataset_info.json", "w") as f:
         json.dump(dataset_info, f, indent=4)
@@ -242,14 +276,21 @@ def main(sft: bool, dpo: bool):
         json.dump(ds_config, f, indent=4)
 
     if sft:
+        config, data, model, hf_model = (
+            (sft_all_config, SFT_ALL_DATA, SFT_ALL_MODEL, SFT_ALL_HF_MODEL)
+            if one_shot
+            else (sft_int_config, SFT_INT_DATA, SFT_INT_MODEL, SFT_INT_HF_MODEL)
+            if int_coords
+            else (sft_config, SFT_DATA, SFT_MODEL, SFT_HF_MODEL)
+        )
         with open(TRAIN_REPO_PATH / SFT_YAML, "w") as f:
-            yaml.dump(sft_config, f)
+            yaml.dump(config, f)
         os.chdir(TRAIN_REPO_PATH)
         _exec_subprocess(
             [
                 "cp",
-                str(DATA_VOL_PATH / SFT_DATA),
-                f"data/{SFT_DATA}",
+                str(DATA_VOL_PATH / data),
+                f"data/{data}",
             ]
         )
         _exec_subprocess(
@@ -261,11 +302,11 @@ def main(sft: bool, dpo: bool):
         )
         checkpoint_folder = str(
             max(
-                list((RUNS_VOL_PATH / SFT_MODEL).glob("checkpoint-*")),
+                list((RUNS_VOL_PATH / model).glob("checkpoint-*")),
                 key=lambda x: int(x.name.split("-")[-1]),
             )
         )
-        push_to_hub(checkpoint_folder, SFT_HF_MODEL)
+        push_to_hub(checkpoint_folder, hf_model)
     if dpo:
         with open(TRAIN_REPO_PATH / DPO_YAML, "w") as f:
             yaml.dump(dpo_train_config, f)
@@ -306,10 +347,15 @@ def main(sft: bool, dpo: bool):
     secrets=SECRETS,
     timeout=TIMEOUT,
 )
-def run(sft: bool, dpo: bool):
-    main(sft, dpo)
+def run(sft: bool, dpo: bool, one_shot: bool, int_coords: bool):
+    main(sft, dpo, one_shot, int_coords)
 
 
 @app.local_entrypoint()
-def local(sft: bool = False, dpo: bool = False):
-    run.remote(sft, dpo)
+def local(
+    sft: bool = False,
+    dpo: bool = False,
+    one_shot: bool = False,
+    int_coords: bool = False,
+):
+    run.remote(sft, dpo, one_shot, int_coords)
@@ -1,15 +1,30 @@
-import base64
+import contextlib
+import hashlib
 import io
+import json
+import multiprocessing
 import os
 import random
+import runpy
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from difflib import get_close_matches
 from pathlib import Path, PurePosixPath
+from typing import Literal
 
 import modal
 from dotenv import load_dotenv
 from PIL import Image
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field, create_model
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
 
 random.seed(42)
 APP_NAME = "mhf"
@@ -38,62 +53,288 @@ class Colors:
 
 
 # image validation
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
+MAX_FILE_SIZE_MB = 5
+MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+MAX_DIMENSIONS = (4096, 4096)
+IMAGE_FORMATS = {"JPEG", "MPO", "PNG", "GIF", "BMP", "TIFF"}
+UPLOAD_CHUNK_BYTES = 64 * 1024  # also enough to hold most image headers
+UPLOAD_MAX_BYTES = MAX_FILE_SIZE_BYTES + UPLOAD_CHUNK_BYTES  # + multipart overhead
+
+
 def validate_image_file(
     image_file,
-) -> dict[str, str]:
+    timings: dict[str, float] = None,
+) -> dict[str, str | bytes]:
+    """
+    Read an upload in chunks, enforcing the size limit as it is read and
+    checking the header after the first chunk, so oversize or non-image
+    uploads are rejected before they are fully read or decoded.
+    """
     if image_file is not None:
-        valid_extensions = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
         file_extension = Path(image_file.filename).suffix.lower()
-        if file_extension not in valid_extensions:
+        if file_extension not in IMAGE_EXTENSIONS:
             return {"error": "Invalid file type. Please upload an image."}
         image_file.file.seek(0)  # reset pointer in case of multiple uploads
-        img_bytes = image_file.file.read()
-        image_base64 = base64.b64encode(img_bytes).decode("utf-8")
-        return validate_image_base64(image_base64)
+        chunks, size, probed = [], 0, False
+        while chunk := image_file.file.read(UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > MAX_FILE_SIZE_BYTES:
+                return {
+                    "error": f"File size exceeds {MAX_FILE_SIZE_MB}MB limit.",
+                    "status_code": 413,
+                }
+            chunks.append(chunk)
+            if not probed:
+                probed = True
+                response = probe_image(chunk)
+                if "error" in response.keys() and "status_code" in response.keys():
+                    return response
+        return validate_image_bytes(b"".join(chunks), timings)
     return {"error": "No image uploaded"}
 
 
-MAX_FILE_SIZE_MB = 5
-MAX_DIMENSIONS = (4096, 4096)
-
+def probe_image(header: bytes) -> dict:
+    """Check format and dimensions from the image header alone (no pixel decode).
 
-def validate_image_base64(image_base64: str) -> dict[str, str]:
-    # Verify MIME type and magic #
-    img = Image.open(io.BytesIO(base64.b64decode(image_base64)))
+    Errors that are certain from the header carry a `status_code`; a header
+    that is merely too short to parse returns a plain error.
+    """
     try:
-        img.verify()
+        img = Image.open(io.BytesIO(header))  # lazy: reads the header only
     except Exception as e:
         return {"error": e}
-
-    # Limit img size
-    if len(image_base64) > MAX_FILE_SIZE_MB * 1024 * 1024:
-        return {"error": f"File size exceeds {MAX_FILE_SIZE_MB}MB limit."}
+    if img.format not in IMAGE_FORMATS:
+        return {"error": f"Unsupported image format: {img.format}.", "status_code": 400}
     if img.size[0] > MAX_DIMENSIONS[0] or img.size[1] > MAX_DIMENSIONS[1]:
         return {
-            "error": f"Image dimensions exceed {MAX_DIMENSIONS[0]}x{MAX_DIMENSIONS[1]} pixels limit."
+            "error": f"Image dimensions exceed {MAX_DIMENSIONS[0]}x{MAX_DIMENSIONS[1]} pixels limit.",
+            "status_code": 400,
         }
+    return {"success": img.size}
 
-    # Run antivirus
-    # write image_base64 to tmp file
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        tmp_file.write(base64.b64decode(image_base64))
-        tmp_file_path = tmp_file.name
 
+def validate_image_bytes(
+    img_bytes: bytes, timings: dict[str, float] = None
+) -> dict[str, str | bytes]:
+    """`timings`, if given, receives the antivirus scan's seconds."""
+    # Limit img size
+    if len(img_bytes) > MAX_FILE_SIZE_BYTES:
+        return {"error": f"File size exceeds {MAX_FILE_SIZE_MB}MB limit."}
+
+    # Check format and dimensions from the header before any decoding
+    response = probe_image(img_bytes)
+    if "error" in response.keys():
+        return {"error": response["error"]}
+
+    # Verify MIME type and magic #
     try:
-        result = subprocess.run(  # noqa: S603
-            ["python", "main.py", str(tmp_file_path)],  # noqa: S607
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=PARENT_PATH / "Python-Antivirus",
-        )
-        scan_result = result.stdout.strip().lower()
+        Image.open(io.BytesIO(img_bytes)).verify()
+    except Exception as e:
+        return {"error": e}
+
+    # Run antivirus
+    start = time.perf_counter()
+    try:
+        scan_result = SCANNER.scan(img_bytes)
+        if timings is not None:
+            timings["scan"] = time.perf_counter() - start
         if scan_result == "infected":
             return {"error": "Potential threat detected."}
     except Exception as e:
         return {"error": f"Error during antivirus scan: {e}"}
 
-    return {"success": image_base64}
+    return {"success": img_bytes}
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that bounds request bodies while they stream in.
+
+    A malformed Content-Length is rejected with 400 and one over the limit with
+    413, before any of the body is read; otherwise reading stops with 413 as
+    soon as the received bytes cross it. `path_limits` overrides the limit for
+    specific paths, and `on_reject(path, status_code)` sees every rejection.
+    """
+
+    def __init__(
+        self,
+        app,
+        max_bytes: int = UPLOAD_MAX_BYTES,
+        path_limits: dict[str, int] = None,
+        on_reject: Callable[[str, int], None] = None,
+    ):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_limits = path_limits or {}
+        self.on_reject = on_reject
+
+    def rejected(self, scope, status_code: int):
+        if self.on_reject is not None:
+            self.on_reject(scope["path"], status_code)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limit = self.path_limits.get(scope["path"], self.max_bytes)
+        detail = f"Request body exceeds {limit} bytes."
+        content_length = dict(scope["headers"]).get(b"content-length", b"0")
+        status_code = None
+        if not content_length.isdigit():
+            status_code, detail = 400, "Invalid Content-Length header."
+        elif int(content_length) > limit:
+            status_code = 413
+        if status_code is not None:
+            self.rejected(scope, status_code)
+            response = JSONResponse({"detail": detail}, status_code=status_code)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    self.rejected(scope, 413)
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+ANTIVIRUS_PATH = PARENT_PATH / "Python-Antivirus"
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "2"))  # long-lived scanner processes
+SCAN_CACHE_SIZE = int(os.getenv("SCAN_CACHE_SIZE", "4096"))  # verdicts kept in memory
+# function in Python-Antivirus' main.py taking a path, returning or printing the verdict
+ANTIVIRUS_SCAN_FUNCTION = os.getenv("ANTIVIRUS_SCAN_FUNCTION", "scan")
+
+scan_worker = {}  # per worker process: the loaded scan function and scratch file
+
+
+def init_scan_worker():
+    """Load Python-Antivirus once per worker, signatures and all, keeping its
+    module namespace alive for every scan."""
+    os.chdir(ANTIVIRUS_PATH)
+    sys.path.insert(0, str(ANTIVIRUS_PATH))
+    namespace = runpy.run_path("main.py", run_name="antivirus")  # skip its CLI
+    scan = namespace.get(ANTIVIRUS_SCAN_FUNCTION)
+    if not callable(scan):
+        raise RuntimeError(f"Python-Antivirus has no `{ANTIVIRUS_SCAN_FUNCTION}`")
+    scratch_dir = tempfile.TemporaryDirectory()  # removed when the worker exits
+    scan_worker.update(
+        namespace=namespace,
+        scan=scan,
+        scratch_dir=scratch_dir,
+        path=Path(scratch_dir.name) / "upload",
+    )
+
+
+def scan_in_worker(img_bytes: bytes) -> str:
+    """Scan with the already loaded antivirus; the verdict is what its scan
+    function returns or, like its CLI, prints."""
+    path = scan_worker["path"]
+    path.write_bytes(img_bytes)  # one scratch file per worker, overwritten
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        verdict = scan_worker["scan"](str(path))
+    return str(out.getvalue() if verdict is None else verdict).strip().lower()
+
+
+class Scanner:
+    """
+    Pool of long-lived antivirus worker processes with a verdict cache.
+
+    Workers are spawned on first use and load the antivirus module, with its
+    signatures, once; each scan then only calls its scan function. Image bytes
+    are sent over the pool's pipe. Verdicts are keyed by content hash, so
+    re-validating an image never rescans it.
+    """
+
+    def __init__(self, workers: int = SCAN_WORKERS, cache_size: int = SCAN_CACHE_SIZE):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.pool = None
+        self.verdicts: OrderedDict[str, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def scan(self, img_bytes: bytes) -> str:
+        key = hashlib.sha256(img_bytes).hexdigest()
+        with self.lock:
+            if key in self.verdicts:
+                self.hits += 1
+                self.verdicts.move_to_end(key)
+                return self.verdicts[key]
+            self.misses += 1
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_scan_worker,
+                )
+            pool = self.pool
+        try:
+            verdict = pool.submit(scan_in_worker, img_bytes).result()
+        except BrokenProcessPool:
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = None  # respawn on the next scan
+            raise
+        with self.lock:
+            self.verdicts[key] = verdict
+            while len(self.verdicts) > self.cache_size:
+                self.verdicts.popitem(last=False)
+        return verdict
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "scan_hits": self.hits,
+            "scan_misses": self.misses,
+            "scan_hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+SCANNER = Scanner()
+
+
+def load_image(img_bytes: bytes) -> tuple[Image.Image, tuple[int, int]]:
+    """
+    Decode validated image bytes once into the 800x600 RGB frame used in training.
+
+    JPEGs are decoded at the smallest DCT scale that still covers the frame, so
+    large uploads never decode at full resolution. Returns the image and the
+    original (width, height) for `scale_points`.
+    """
+    img = Image.open(io.BytesIO(img_bytes))
+    size = img.size
+    img.draft("RGB", RESIZE_DIMENSIONS)  # no-op for non-JPEGs
+    img = img.convert("RGB")
+    if img.size != RESIZE_DIMENSIONS:
+        img = img.resize(RESIZE_DIMENSIONS, Image.Resampling.BICUBIC, reducing_gap=2.0)
+    return img, size
+
+
+def scale_points(
+    dict_outputs: dict[str, list[list[float]]],
+    size: tuple[int, int],
+    int_coords: bool = False,
+) -> dict[str, list[list[float]]]:
+    """Map points from the model's 800x600 frame back to an image of `size`.
+
+    With `int_coords`, points stay whole pixels after scaling."""
+    scale_x, scale_y = size[0] / RESIZE_DIMENSIONS[0], size[1] / RESIZE_DIMENSIONS[1]
+    ndigits = None if int_coords else 2
+    return {
+        name: [
+            [round(x * scale_x, ndigits), round(y * scale_y, ndigits)]
+            for x, y in points
+        ]
+        for name, points in dict_outputs.items()
+    }
 
 
 # model
@@ -104,6 +345,10 @@ BASE_QUANT_MODEL = f"{HF_USERNAME}/{APP_NAME}-{BASE_HF_MODEL.split('/')[1]}-AWQ"
 SFT_MODEL = "qwen2.5-vl-3b-instruct-full-sft"
 SFT_HF_MODEL = f"{HF_USERNAME}/{APP_NAME}-{SFT_MODEL}"  # pretrained model or ckpt
 SFT_QUANT_MODEL = f"{SFT_HF_MODEL}-awq"
+SFT_ALL_MODEL = f"{SFT_MODEL}-all"  # one-shot (all substructures per prompt)
+SFT_ALL_HF_MODEL = f"{HF_USERNAME}/{APP_NAME}-{SFT_ALL_MODEL}"
+SFT_INT_MODEL = f"{SFT_MODEL}-int"  # integer pixel coordinates
+SFT_INT_HF_MODEL = f"{HF_USERNAME}/{APP_NAME}-{SFT_INT_MODEL}"
 DPO_MODEL = "qwen2.5-vl-3b-instruct-lora-dpo"
 DPO_MERGED = f"{DPO_MODEL}-merged"
 DPO_HF_MODEL = f"{HF_USERNAME}/{APP_NAME}-{DPO_MERGED}"  # pretrained model or ckpt
@@ -124,12 +369,27 @@ Return a json object as follows:
 {{
     "name": "{{substructure}}",
     "points": [
-        {{"x": float, "y": float}},
+        {{"x": {coord}, "y": {coord}}},
         ...
     ]
 }}
 ```
 """
+DEFAULT_ALL_USER_PROMPT = """
+Detect the following substructures in the 2D ultrasound and return the location of each in the form of an xy-point-based outline:
+{substructures}
+Note that the ultrasounds are of size 800x600 which indicates the limits of the x and y coordinates.
+Return a json object with every substructure as follows:
+```json
+{{
+    "{{substructure}}": [
+        {{"x": {coord}, "y": {coord}}},
+        ...
+    ],
+    ...
+}}
+```
+"""
 SUBSTRUCTURE_INFO = {
     "calota": {"min": 4, "max": 6},
     "cavum": {"min": 4, "max": 5},
@@ -146,12 +406,178 @@ class Point(BaseModel):
     y: float
 
 
+class IntPoint(BaseModel):
+    x: int
+    y: int
+
+
 class Substructure(BaseModel):
     name: str
     points: list[Point]
 
 
+class IntSubstructure(BaseModel):
+    name: str
+    points: list[IntPoint]
+
+
+class BoundedPoint(BaseModel):
+    x: float = Field(ge=0, le=RESIZE_DIMENSIONS[0])
+    y: float = Field(ge=0, le=RESIZE_DIMENSIONS[1])
+
+
+class BoundedIntPoint(BaseModel):
+    x: int = Field(ge=0, le=RESIZE_DIMENSIONS[0])
+    y: int = Field(ge=0, le=RESIZE_DIMENSIONS[1])
+
+
+def substructure_model(substructure: str, int_coords: bool = False) -> type[BaseModel]:
+    """`Substructure` with the name fixed and the point count and range bounded."""
+    info = SUBSTRUCTURE_INFO[substructure]
+    return create_model(
+        "Substructure",
+        name=(Literal[substructure], ...),
+        points=(
+            list[BoundedIntPoint if int_coords else BoundedPoint],
+            Field(min_length=info["min"], max_length=info["max"]),
+        ),
+    )
+
+
+def substructures_model(int_coords: bool = False) -> type[BaseModel]:
+    """One-shot answer: every substructure's bounded points, keyed by its name."""
+    point = BoundedIntPoint if int_coords else BoundedPoint
+    return create_model(
+        "Substructures",
+        __config__=ConfigDict(extra="forbid"),
+        **{
+            substructure: (
+                list[point],
+                Field(min_length=info["min"], max_length=info["max"]),
+            )
+            for substructure, info in SUBSTRUCTURE_INFO.items()
+        },
+    )
+
+
+Substructures = substructures_model()
+IntSubstructures = substructures_model(int_coords=True)
 JSON_STRUCTURE = Substructure.model_json_schema()
+JSON_ALL_STRUCTURE = Substructures.model_json_schema()
+JSON_ALL_INT_STRUCTURE = IntSubstructures.model_json_schema()
+SUBSTRUCTURE_SCHEMAS = {
+    substructure: substructure_model(substructure).model_json_schema()
+    for substructure in SUBSTRUCTURE_INFO
+}
+SUBSTRUCTURE_INT_SCHEMAS = {
+    substructure: substructure_model(substructure, int_coords=True).model_json_schema()
+    for substructure in SUBSTRUCTURE_INFO
+}
+
+
+def build_schemas(one_shot: bool = False, int_coords: bool = False) -> list[dict]:
+    """Guided-decoding schemas aligned with `build_conversations`."""
+    if one_shot:
+        return [JSON_ALL_INT_STRUCTURE if int_coords else JSON_ALL_STRUCTURE]
+    schemas = SUBSTRUCTURE_INT_SCHEMAS if int_coords else SUBSTRUCTURE_SCHEMAS
+    return [schemas[substructure] for substructure in SUBSTRUCTURE_INFO]
+
+
+def coord_type(int_coords: bool = False) -> str:
+    """Coordinate type named in the prompts' example JSON."""
+    return "int" if int_coords else "float"
+
+
+def format_user_prompt(substructure: str, int_coords: bool = False) -> str:
+    """Per-substructure prompt with its point bounds."""
+    info = SUBSTRUCTURE_INFO[substructure]
+    return DEFAULT_USER_PROMPT.format(
+        substructure=substructure,
+        min=info["min"],
+        max=info["max"],
+        coord=coord_type(int_coords),
+    )
+
+
+def format_all_user_prompt(int_coords: bool = False) -> str:
+    """One-shot prompt listing every substructure with its point bounds."""
+    return DEFAULT_ALL_USER_PROMPT.format(
+        substructures="\n".join(
+            f"- {substructure}: at least {info['min']} points and at most {info['max']} points"
+            for substructure, info in SUBSTRUCTURE_INFO.items()
+        ),
+        coord=coord_type(int_coords),
+    )
+
+
+def build_conversations(
+    image: Image.Image,
+    one_shot: bool = False,
+    int_coords: bool = False,
+) -> list[list[dict]]:
+    """
+    One chat conversation per substructure, all sharing the same image.
+
+    The image comes first, as in the SFT data, so the system prompt and image
+    form a prefix common to every substructure prompt that the engine can
+    prefill once and reuse.
+
+    With `one_shot`, a single conversation asks for every substructure at once.
+    With `int_coords`, the prompts ask for whole-pixel coordinates.
+    """
+    image = {"type": "image", "image": image}  # decoded once, shared by every prompt
+    if one_shot:
+        texts = [format_all_user_prompt(int_coords)]
+    else:
+        texts = [
+            format_user_prompt(substructure, int_coords)
+            for substructure in SUBSTRUCTURE_INFO
+        ]
+    conversations = []
+    for text in texts:
+        text = {"type": "text", "text": text}
+        conversations.append(
+            [
+                {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
+                {"role": "user", "content": [image, text]},
+            ]
+        )
+    return conversations
+
+
+def parse_outputs(outputs: list[str]) -> dict[str, list[list[float]]]:
+    """Parse raw model outputs into {substructure: [[x, y], ...]}.
+
+    Accepts both per-substructure and one-shot (`Substructures`) outputs.
+    Raises ValueError if an output is not valid JSON.
+    """
+    parsed = []
+    for output in outputs:
+        try:
+            new_outputs = json.loads(output)
+        except Exception:
+            raise ValueError(f"Failed to parse output: {output}")
+        if "name" in new_outputs:
+            parsed.append(new_outputs)
+        else:  # one-shot: {substructure: points}
+            parsed.extend(
+                {"name": name, "points": points} for name, points in new_outputs.items()
+            )
+
+    dict_outputs = {}
+    for new_outputs in parsed:
+        name = new_outputs["name"]
+        closest = name
+        if name not in SUBSTRUCTURE_INFO.keys():
+            closest = get_close_matches(
+                name,
+                SUBSTRUCTURE_INFO.keys(),
+                n=len(SUBSTRUCTURE_INFO.keys()),
+                cutoff=0,
+            )[0]
+            print(f"Pred name: {name}, closest name: {closest}")
+        dict_outputs[closest] = [[p["x"], p["y"]] for p in new_outputs["points"]]
+    return dict_outputs
 
 
 # Modal
@@ -199,6 +625,16 @@ else:
     DATA_VOL_PATH = Path(f"/{DATA_VOLUME}")
     RUNS_VOL_PATH = Path(f"/{RUNS_VOLUME}")
 
+
+def local_gpu_count() -> int:
+    """GPUs on this machine; torch only ships with the `gpu` extra."""
+    try:
+        import torch
+    except ImportError:
+        return 0
+    return torch.cuda.device_count()
+
+
 CPU = 4  # cores (Modal soft limit)
 MEM = 2048  # MB (Modal soft limit)
 MINUTES = 60  # seconds
@@ -258,7 +694,7 @@ GPU_IMAGE = (
             "WANDB_PROJECT": APP_NAME,
         }
     )
-    .add_local_python_source("utils")
+    .add_local_python_source("utils", "engine")
 )
 
 